@@ -0,0 +1,149 @@
+#!/usr/bin/env python2
+
+'''Compare the per-line and whole-diff character checks of CharCheck.
+
+Checks either a diff from a file, such as the output of
+
+    git diff -U0 master...fork/branch -- data/TABLE.ratdb
+
+or a synthetic diff of a large data table with a few problems in it, with
+the per-line check CharCheck used before and with CharCheck.char_check.
+Prints the wall times and whether both report the same errors.
+'''
+
+import time
+import random
+import argparse
+from cog.tasks.chartest import CharCheck, CHAR_MIN, CHAR_MAX, ALLOWED_CHARS
+
+
+parser = argparse.ArgumentParser('Benchmark the CharCheck character check')
+parser.add_argument('diff',nargs='?',help='diff file to check (default: a synthetic diff)')
+parser.add_argument('-s','--size',default=8,type=float,help='size of the synthetic diff in MB')
+parser.add_argument('-r','--repeat',default=3,type=int,help='number of runs of each check; the fastest is reported')
+
+args = parser.parse_args()
+
+def make_diff(size):
+    '''Make a diff adding a table of numbers in hunks of up to 1000 lines.
+
+    About one line in 5000 has a tab, a CR, a non-ASCII character or
+    trailing whitespace.
+
+    :param size: Approximate size in bytes
+    :returns: The diff string
+    '''
+    rng = random.Random(1)
+    parts = ['diff --git a/data/TABLE.ratdb b/data/TABLE.ratdb\n',
+             'index 1111111..2222222 100644\n',
+             '--- a/data/TABLE.ratdb\n', '+++ b/data/TABLE.ratdb\n']
+    problems = ['\t', '\r', '\xc2\xb5', ' ']
+    length = 0
+    line_number = 1
+    while length < size:
+        lines = rng.randint(1, 1000)
+        parts.append('@@ -%i,0 +%i,%i @@\n' % (line_number, line_number,
+                                                lines))
+        for i in range(lines):
+            line = '+  value_%i: [%s],' % (
+                line_number, ', '.join('%.6f' % rng.random()
+                                       for j in range(6)))
+            if rng.randint(0, 5000) == 0:
+                line += rng.choice(problems)
+            parts.append(line + '\n')
+            length += len(line) + 1
+            line_number += 1
+        line_number += 10  # unchanged lines between hunks
+    return ''.join(parts)
+
+def char_check_lines(diff):
+    '''The check CharCheck made before, line by line over the whole diff.
+
+    :param diff: the diff string
+    :returns: a list of errors for the file
+    '''
+    errors = []
+
+    if "\ No newline at end of file" in diff:
+        errors.append("No EOF newline")
+
+    line_number = -999
+
+    for line, line_lb in zip(diff.splitlines(False), diff.splitlines(True)):
+        if line[:2] == "@@":
+            line_number = CharCheck.hunk_start(line)
+
+        if len(line) == 0 or line[0] != "+" or line[:3] == "+++":
+            continue
+
+        line = line[1:]
+
+        trailing_white_space = len(line) - len(line.rstrip())
+        if trailing_white_space:
+            errors.append("{} trailing whitespace {} on line {}: "
+                          "'{}'".format(trailing_white_space,
+                                        "chars" if trailing_white_space > 1 else "char",
+                                        line_number,
+                                        line[0:100]))
+
+        try:
+            line_unicode = line_lb.decode('utf-8')
+        except UnicodeDecodeError:
+            line_unicode = line_lb
+            errors.append("Could not decode line {} using UTF-8. "
+                          "Please check the file encoding.".format(line_number))
+
+        if ord(min(line_unicode)) < CHAR_MIN or ord(max(line_unicode)) > CHAR_MAX:
+            bad_chars = {}
+            for c in line_unicode:
+                co = ord(c)
+                if (co < CHAR_MIN or co > CHAR_MAX) and (co not in ALLOWED_CHARS):
+                    bad_chars[c] = bad_chars.get(c, 0) + 1
+
+            for c, count in bad_chars.items():
+                error = ("{} {} of char {} on line {}: "
+                         "'{}'".format(count,
+                                       "copy" if count == 1 else "copies",
+                                       hex(ord(c)),
+                                       line_number,
+                                       line[0:100]))
+
+                if ord(c) == 0x09:
+                    error += " <b>=> new TABs</b>"
+                elif ord(c) == 0x0d:
+                    error += " <b>=> carriage return (Windows-style line ending?)</b>"
+
+                errors.append(error)
+
+        line_number += 1
+
+    return errors
+
+if args.diff:
+    with open(args.diff) as f:
+        diff = f.read()
+else:
+    diff = make_diff(args.size * 1024 * 1024)
+
+task = CharCheck()
+print 'Checking a diff of %.1f MB, %i lines' % (len(diff) / 1024.0 / 1024,
+                                                diff.count('\n'))
+
+timings = {}
+errors = {}
+for mode, check in (('per-line', char_check_lines),
+                    ('bulk', task.char_check)):
+    best = None
+    for i in range(args.repeat):
+        start = time.time()
+        errors[mode] = check(diff)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    timings[mode] = best
+    print '%-8s %8.3f s  %i errors' % (mode, best, len(errors[mode]))
+
+if timings['bulk']:
+    print 'speedup  %8.1f' % (timings['per-line'] / timings['bulk'])
+# bad characters on one line may be reported in either order
+print 'same errors: %s' % (sorted(errors['per-line']) ==
+                           sorted(errors['bulk']))
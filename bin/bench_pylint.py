@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+
+'''Compare a serial pylint run with the sharded run of the pylint task.
+
+Lints either the Python files of a RAT checkout, found as the task finds
+them, or a synthetic tree of generated modules, first with one pylint
+process over all files (as the task used to) and then with
+PyLint.run_pylint, and prints the wall times and message counts.
+'''
+
+import os
+import glob
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import cog.task
+from cog.tasks.pylint import PyLint
+
+
+parser = argparse.ArgumentParser('Benchmark serial and sharded pylint')
+parser.add_argument('checkout',nargs='?',help='RAT checkout to lint (default: a synthetic tree)')
+parser.add_argument('-n','--modules',default=200,type=int,help='number of synthetic modules')
+parser.add_argument('-j','--jobs',default=None,type=int,help='number of shards (default: the CPUs of the job)')
+parser.add_argument('-r','--repeat',default=1,type=int,help='number of runs of each mode; the fastest is reported')
+
+args = parser.parse_args()
+
+if args.jobs:
+    os.environ['SLURM_CPUS_PER_TASK'] = str(args.jobs)
+
+def make_tree(path, n_modules):
+    '''Write a package of modules of varying size that import each other.
+
+    :param path: Directory to write the package in
+    :param n_modules: Number of modules
+    '''
+    package = os.path.join(path, 'python', 'synthetic')
+    os.makedirs(package)
+    open(os.path.join(package, '__init__.py'), 'w').close()
+    for i in range(n_modules):
+        with open(os.path.join(package, 'mod%i.py' % i), 'w') as f:
+            f.write('"""Synthetic module %i."""\nimport os\n' % i)
+            if i:
+                f.write('from synthetic import mod%i\n' % (i // 2))
+            # sizes vary by a factor of 20 so that sharding has to balance
+            for j in range(5 + (i * 7) % 100):
+                f.write('\n\ndef func%i(value, unused=None):\n'
+                        '    """Return a value."""\n'
+                        '    result = []\n'
+                        '    for item in range(value):\n'
+                        '        if item %% 3 == 0 and os.sep:\n'
+                        '            result.append(item * %i)\n'
+                        '    return result\n' % (j, j))
+
+task = PyLint()
+if args.checkout:
+    checkout_path = os.path.abspath(args.checkout)
+else:
+    checkout_path = tempfile.mkdtemp()
+    make_tree(checkout_path, args.modules)
+    task.file_list = ['python']
+
+# expand the globs as PyLint.run does
+file_list = []
+for path in task.file_list:
+    for full_path in glob.glob(os.path.join(checkout_path, path)):
+        file_list.append(os.path.relpath(full_path, checkout_path))
+task.file_list = file_list
+files = task.get_python_files(checkout_path)
+
+cmd_list = ['python3', '-m', 'pylint',
+            '--enable={0}'.format(','.join(task.messages_enable)),
+            '--disable={0}'.format(','.join(task.messages_disable)),
+            '--score=n',
+            '--generated-members=plot_options',
+            '--ignored-modules=ROOT,SCons',
+            '--output-format=json',
+            '--ignore={0}'.format(','.join(task.ignore_list))]
+
+out_dir = tempfile.mkdtemp()
+file_json = os.path.join(out_dir, 'pylint.json')
+file_log = os.path.join(out_dir, 'pylint.log')
+
+def run_serial():
+    with open(file_json, 'w') as out, open(file_log, 'w') as err:
+        return subprocess.call(cmd_list + files, cwd=checkout_path,
+                               stdout=out, stderr=err)
+
+def run_sharded():
+    return task.run_pylint(checkout_path, cmd_list, files, file_json,
+                           file_log)
+
+print 'Linting %i files with %i shards' % (len(files), cog.task.cpu_count())
+
+timings = {}
+for mode, run in (('serial', run_serial), ('sharded', run_sharded)):
+    best = None
+    for i in range(args.repeat):
+        start = time.time()
+        code = run()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    with open(file_json) as f:
+        messages = json.load(f)
+    timings[mode] = best
+    print '%-8s %8.2f s  return code %i, %i messages' % \
+        (mode, best, code, len(messages))
+
+if timings['sharded']:
+    print 'speedup  %8.2f' % (timings['serial'] / timings['sharded'])
+
+shutil.rmtree(out_dir)
+if not args.checkout:
+    shutil.rmtree(checkout_path)
@@ -26,7 +26,10 @@ db = couchdb.database
 
 pending = db.view('pytunia/'+args.status+'_tasks',start_key=args.newer_than,ascending=True)
 
-clear_fields = ['queued','started','completed']
+# job and cache bookkeeping go too, so the task is submitted afresh and is
+# not used as a cached result before it completes again
+clear_fields = ['queued','started','completed','job_id','submitted',
+                'requeues','cancelled','result_key','input_key']
 batch = []
 for result in pending:
     print result.id
@@ -1,7 +1,14 @@
 '''SLURM cluster interface.'''
 
+import os
+import re
+import pipes
 import time
+import getpass
+import tempfile
 import subprocess
+import collections
+import couchdb
 
 class SLURMCluster(object):
     '''An interface to a local SLURM cluster.
@@ -18,56 +25,133 @@ class SLURMCluster(object):
             'cpu_count is 2': ['reallyoldnodes']
         }
 
+    Batches of tasks are submitted as job arrays; the manifests listing their
+    document IDs are written to `manifest_dir`, which must be on a filesystem
+    shared with the compute nodes.
+
+    Tasks named in `grouped_tasks` are instead coalesced per record and
+    revision into a single job, which runs their task module with "--group"
+    so they can share one checkout and build.
+
+    The `cpus_per_task` map gives the number of CPUs to request for each task
+    name, with the key 'default' for any other task, e.g.:
+
+        {'build': 8, 'rattest': 4, 'default': 1}
+
+    If no count applies, the SLURM default is used. `mem_per_task` and
+    `time_per_task` likewise give the memory and time limit to request, in
+    sbatch syntax, e.g. {'rattest': '4G'} and {'default': '2:00:00'}, and
+    `nice_per_task` the SLURM nice value, which lowers a job's priority in the
+    queue relative to the others. Nice values below zero need privileges, so
+    they are raised to zero.
+
+    Each task document records the SLURM job running it as `job_id`. Tasks
+    whose job leaves the queue without completing the task (after a node
+    failure, running out of memory or time, ...) are found by `reconcile`, and
+    are requeued up to `max_requeues` times before being marked failed.
+
     :param default_partition: The name of the default SLURM partition, or None
     :param partition_map: A map of system requirements to partitions
+    :param manifest_dir: Directory for job array manifests
+    :param grouped_tasks: Names of tasks to run grouped by revision
+    :param cpus_per_task: A map of task names to CPU counts
+    :param max_requeues: Number of times to requeue a task whose job was lost
+    :param mem_per_task: A map of task names to memory requests
+    :param time_per_task: A map of task names to time limits
+    :param nice_per_task: A map of task names to nice values
+    :param supersede: Cancel the tasks of records superseded by newer ones
+                      for the same branch; see `cancel_superseded`
     '''
-    def __init__(self, default_partition=None, partition_map=None):
+    # SLURM job states in which a job may still run the task
+    active_states = ['PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING',
+                     'SUSPENDED', 'REQUEUED', 'RESIZING']
+
+    def __init__(self, default_partition=None, partition_map=None,
+                 manifest_dir=None, grouped_tasks=None, cpus_per_task=None,
+                 max_requeues=1, mem_per_task=None, time_per_task=None,
+                 nice_per_task=None, supersede=False):
         self.default_partition = default_partition
         self.partition_map = partition_map or {}
+        self.manifest_dir = (manifest_dir or
+                             os.path.expanduser('~/.cog/manifests'))
+        self.grouped_tasks = grouped_tasks or []
+        self.cpus_per_task = cpus_per_task or {}
+        self.max_requeues = max_requeues
+        self.mem_per_task = mem_per_task or {}
+        self.time_per_task = time_per_task or {}
+        self.nice_per_task = nice_per_task or {}
+        self.supersede = supersede
+        self.seen_records = collections.OrderedDict()
+        self.branch_keys = collections.OrderedDict()
 
     @staticmethod
     def submit_job(command, args, partition=None, node=None, stdout=None,
-            stderr=None):
+            stderr=None, array=None, cpus=None, mem=None, time_limit=None,
+            nice=None, name=None):
         '''Submit a job to the SLURM cluster.
 
-        Uses the `q` script located in `bin`.
- 
+        Runs `sbatch` directly, wrapping the command in a batch script, rather
+        than starting the `q` script in `bin` for every job. Like `q`, the job
+        inherits the current environment and working directory.
+
         :param command: The command to run
         :param args: Command-line arguments
         :param partition: Submit to specific SLURM partition(s)
         :param node: Submit to specific SLURM node(s)
         :param stdout: Filename to which to write stdout
         :param stderr: Filename to which to write stderr
-        :returns: Return code of system call to `q`
+        :param array: Job array index specification, e.g. "0-9"
+        :param cpus: Number of CPUs to allocate to each task
+        :param mem: Memory to allocate, e.g. "4G"
+        :param time_limit: Time limit, e.g. "2:00:00"
+        :param nice: Nice value, from 0 (the default) up
+        :param name: Job name, by default the command
+        :returns: The SLURM job ID, or None if the submission failed
         '''
-        q_cmd = 'q'
-        q_args = ''
+        sbatch_args = ['--parsable', '-J', name or command]
         if node is not None:
-            q_args += ' -w ' + node
+            sbatch_args += ['-w', node]
         if partition is not None:
-            q_args += ' -p ' + partition
+            sbatch_args += ['-p', partition]
         if stdout is not None:
-            q_args += ' -so ' + stdout
+            sbatch_args += ['-o', stdout]
         if stderr is not None:
-            q_args += ' -se ' + stderr
+            sbatch_args += ['-e', stderr]
+        if array is not None:
+            sbatch_args += ['--array', array]
+        if cpus is not None:
+            sbatch_args += ['-c', str(cpus)]
+        if mem is not None:
+            sbatch_args += ['--mem', str(mem)]
+        if time_limit is not None:
+            sbatch_args += ['--time', str(time_limit)]
+        if nice is not None:
+            sbatch_args += ['--nice=%i' % nice]
 
-        full_command = [q_cmd] + q_args.split() + [command] + args.split()
+        script = ' '.join(pipes.quote(word)
+                          for word in [command] + args.split())
+        full_command = ['sbatch'] + sbatch_args + ['--wrap', script]
         print ' '.join(full_command)
 
-        code = 0
         try:
-            subprocess.check_call(full_command)
-        except subprocess.CalledProcessError as err:
-            code = err.returncode
-            print 'submit_job: Error "%s"' % err.output
+            output = subprocess.check_output(full_command)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print 'submit_job: Error "%s"' % err
+            return None
 
-        return code
+        # --parsable prints "<job id>" or "<job id>;<cluster>"
+        job_id = output.strip().split(';')[0]
+        if not job_id.isdigit():
+            print 'submit_job: No job ID in "%s"' % output.strip()
+            return None
+
+        return job_id
+
+    def get_partition(self, document):
+        '''Choose the partition(s) for a task from its system requirements.
 
-    def submit_task(self, database, document):
-        '''Submit a task to the SLURM cluster.
- 
-        :param database: Database to post results to
         :param document: Document defining the task
+        :returns: Comma-separated partition names, or None for the default
         '''
         partition = self.default_partition
 
@@ -78,16 +162,619 @@ class SLURMCluster(object):
                     plist = self.partition_map[req]
                     partition = ','.join(plist) if plist is not None else None
 
-        task_module_name = '.'.join(['cog', 'tasks', document['name']])
+        return partition
+
+    def get_cpus(self, name):
+        '''Get the number of CPUs to request for a task.
+
+        :param name: The task name
+        :returns: CPU count, or None for the SLURM default
+        '''
+        return self.cpus_per_task.get(name, self.cpus_per_task.get('default'))
+
+    def get_job_options(self, name):
+        '''Get the resources to request for a task's job.
+
+        :param name: The task name
+        :returns: Dictionary of keyword arguments for `submit_job`
+        '''
+        mem = self.mem_per_task.get(name, self.mem_per_task.get('default'))
+        time_limit = self.time_per_task.get(name,
+                                            self.time_per_task.get('default'))
+        nice = self.nice_per_task.get(name, self.nice_per_task.get('default'))
+
+        # negative nice values need privileges, so sbatch would fail
+        if nice is not None:
+            try:
+                nice = max(0, int(nice))
+            except (TypeError, ValueError):
+                print 'get_job_options: Ignoring nice value %r for %s' % \
+                    (nice, name)
+                nice = None
+
+        return {
+            'name': 'cog-' + name,
+            'cpus': self.get_cpus(name),
+            'mem': mem,
+            'time_limit': time_limit,
+            'nice': nice
+        }
+
+    @staticmethod
+    def get_task_command(database, name, doc_id, group=False):
+        '''Build the command line that runs a task module.
+
+        :param database: Database to post results to
+        :param name: Name of the task module in `cog.tasks`
+        :param doc_id: Task document ID, or "@" and the path to a manifest
+        :param group: Run all tasks in the manifest `doc_id` in one job
+        :returns: Tuple of (command, arguments)
+        '''
+        task_module_name = '.'.join(['cog', 'tasks', name])
+        if group:
+            task_module_name += ' --group'
 
         cmd = 'python'
         args = '-m %s %s %s %s %s %s' % (task_module_name, database.host,
                                       database.dbname, database.username,
-                                      database.password, document.id)
+                                      database.password, doc_id)
+
+        return cmd, args
+
+    @staticmethod
+    def claim_task(database, document):
+        '''Mark a task as queued, unless it was already claimed.
+
+        The `queued` time is saved against the revision that was read, so if
+        another server claimed the task first the save conflicts.
+
+        :param database: Database the task belongs to
+        :param document: Document defining the task
+        :returns: True if this server now owns the task
+        '''
+        if ('queued' in document or 'started' in document or
+                'completed' in document):
+            print 'claim_task: %s is already queued' % document.id
+            return False
 
-        # indicate that the job is queued
         document['queued'] = time.time()
-        database.database.save(document)
+        try:
+            database.database.save(document)
+        except couchdb.http.ResourceConflict:
+            print 'claim_task: %s was claimed by another server' % document.id
+            return False
+
+        return True
+
+    @staticmethod
+    def claim_tasks(database, documents):
+        '''Mark a batch of tasks as queued in a single request.
+
+        Like `claim_task`, each `queued` marker is saved against the revision
+        that was read; documents that conflict were claimed (or changed) by
+        someone else and are left out.
+
+        :param database: Database the tasks belong to
+        :param documents: List of documents defining the tasks
+        :returns: List of the documents that this server now owns
+        '''
+        unclaimed = []
+        for document in documents:
+            if ('queued' in document or 'started' in document or
+                    'completed' in document):
+                print 'claim_tasks: %s is already queued' % document.id
+            else:
+                unclaimed.append(document)
+
+        if not unclaimed:
+            return []
+
+        now = time.time()
+        for document in unclaimed:
+            document['queued'] = now
+
+        claimed = []
+        results = database.database.update(unclaimed)
+        for document, (success, doc_id, rev_or_exc) in zip(unclaimed, results):
+            if success:
+                claimed.append(document)
+            elif isinstance(rev_or_exc, couchdb.http.ResourceConflict):
+                print 'claim_tasks: %s was claimed by another server' % doc_id
+            else:
+                print 'claim_tasks: Error claiming %s: %s' % \
+                    (doc_id, rev_or_exc)
+
+        return claimed
+
+    @staticmethod
+    def release_tasks(database, documents):
+        '''Return claimed tasks to the pending queue in a single request.
+
+        Used when the job for claimed tasks could not be submitted. Tasks that
+        failed to update are left queued for `reconcile` to pick up.
+
+        :param database: Database the tasks belong to
+        :param documents: List of claimed task documents
+        '''
+        for document in documents:
+            document.pop('queued', None)
+
+        for success, doc_id, rev_or_exc in database.database.update(documents):
+            if not success:
+                print 'release_tasks: Error updating %s: %s' % (doc_id,
+                                                                rev_or_exc)
+
+    @staticmethod
+    def record_jobs(database, jobs):
+        '''Record the SLURM job running each task on its document.
+
+        All documents are updated in one request. A task may already have
+        started and saved a new revision, so conflicting documents are read
+        again and updated once more.
+
+        :param database: Database the tasks belong to
+        :param jobs: List of (document, job ID) tuples
+        '''
+        now = time.time()
+        for document, job_id in jobs:
+            document['job_id'] = job_id
+            document['submitted'] = now
+
+        documents = [document for document, job_id in jobs]
+        results = database.database.update(documents)
+
+        retry = []
+        for document, (success, doc_id, rev_or_exc) in zip(documents, results):
+            if isinstance(rev_or_exc, couchdb.http.ResourceConflict):
+                retry.append(document)
+            elif not success:
+                print 'record_jobs: Error updating %s: %s' % \
+                    (doc_id, rev_or_exc)
+
+        if not retry:
+            return
+
+        latest = []
+        retry = dict((document.id, document) for document in retry)
+        for document in database.get_documents(retry.keys()):
+            if 'completed' not in document:
+                document['job_id'] = retry[document.id]['job_id']
+                document['submitted'] = now
+                latest.append(document)
+
+        for success, doc_id, rev_or_exc in database.database.update(latest):
+            if not success:
+                print 'record_jobs: Error updating %s: %s' % \
+                    (doc_id, rev_or_exc)
+
+    def write_manifest(self, doc_ids):
+        '''Write the document IDs for a job array to a manifest file.
+
+        Line `i` of the manifest holds the ID for array index `i`. The file
+        must be readable from the compute nodes.
+
+        :param doc_ids: List of task document IDs
+        :returns: Path to the manifest file
+        '''
+        if not os.path.exists(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+
+        fd, path = tempfile.mkstemp(prefix='cog-', suffix='.manifest',
+                                    dir=self.manifest_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(doc_ids) + '\n')
+
+        return path
+
+    def submit_task(self, database, document):
+        '''Submit a task to the SLURM cluster.
+ 
+        :param database: Database to post results to
+        :param document: Document defining the task
+        :returns: True if the task was claimed and submitted
+        '''
+        if not SLURMCluster.claim_task(database, document):
+            return False
+
+        partition = self.get_partition(document)
+        cmd, args = SLURMCluster.get_task_command(database, document['name'],
+                                                  document.id)
+
+        options = self.get_job_options(document['name'])
+        job_id = SLURMCluster.submit_job(cmd, args, partition, **options)
+        if job_id is None:
+            SLURMCluster.release_tasks(database, [document])
+            return False
+
+        SLURMCluster.record_jobs(database, [(document, job_id)])
+
+        return True
+
+    def get_group_key(self, document):
+        '''Get the key under which a task is batched with others.
+
+        :param document: Document defining the task
+        :returns: Tuple of (partition, task name, revision), where the
+                  revision is None unless the task is run grouped
+        '''
+        revision = None
+        if document['name'] in self.grouped_tasks:
+            kwargs = document.get('kwargs', {})
+            revision = (document.get('record_id'), kwargs.get('sha'),
+                        kwargs.get('git_url'), kwargs.get('base_repo_url'),
+                        kwargs.get('base_repo_ref'))
+
+        return self.get_partition(document), document['name'], revision
+
+    def submit_tasks(self, database, documents):
+        '''Submit a batch of tasks to the SLURM cluster.
+
+        Tasks of the same type bound for the same partition are submitted
+        together as one job array, whose members look up their document in a
+        manifest by array index. Grouped tasks of the same revision become a
+        single job instead. All tasks are claimed with one bulk update, and
+        tasks whose job could not be submitted are released again.
+
+        :param database: Database to post results to
+        :param documents: List of documents defining the tasks
+        :returns: List of IDs of the tasks that were claimed and submitted
+        '''
+        groups = collections.OrderedDict()
+        for document in SLURMCluster.claim_tasks(database, documents):
+            key = self.get_group_key(document)
+            groups.setdefault(key, []).append(document)
+
+        submitted = []
+        jobs = []
+        failed = []
+        for (partition, name, revision), group in groups.items():
+            doc_ids = [document.id for document in group]
+            options = self.get_job_options(name)
+            if len(doc_ids) == 1:
+                cmd, args = SLURMCluster.get_task_command(database, name,
+                                                          doc_ids[0])
+                job_id = SLURMCluster.submit_job(cmd, args, partition,
+                                                 **options)
+                job_ids = [job_id] * len(group)
+            elif revision is not None:
+                manifest = self.write_manifest(doc_ids)
+                cmd, args = SLURMCluster.get_task_command(database, name,
+                                                          manifest, group=True)
+                job_id = SLURMCluster.submit_job(cmd, args, partition,
+                                                 **options)
+                job_ids = [job_id] * len(group)
+            else:
+                manifest = self.write_manifest(doc_ids)
+                cmd, args = SLURMCluster.get_task_command(database, name,
+                                                          '@' + manifest)
+                array = '0-%i' % (len(doc_ids) - 1)
+                job_id = SLURMCluster.submit_job(cmd, args, partition,
+                                                 array=array, **options)
+                job_ids = ['%s_%i' % (job_id, i) for i in range(len(group))]
+
+            if job_id is None:
+                failed += group
+                continue
+
+            jobs += zip(group, job_ids)
+            submitted += doc_ids
+
+        if jobs:
+            SLURMCluster.record_jobs(database, jobs)
+        if failed:
+            SLURMCluster.release_tasks(database, failed)
+
+        return submitted
+
+    @staticmethod
+    def get_queued_jobs():
+        '''List this user's jobs known to the SLURM controller.
+
+        Job arrays are expanded, so each array element is listed as
+        "<job>_<index>".
+
+        :returns: Set of job IDs, or None if `squeue` failed
+        '''
+        command = ['squeue', '-h', '-r', '-u', getpass.getuser(), '-o', '%i']
+        try:
+            output = subprocess.check_output(command)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print 'get_queued_jobs: Error running squeue:', err
+            return None
+
+        return set(output.split())
+
+    @staticmethod
+    def get_job_states(job_ids):
+        '''Look up the final states of jobs in the SLURM accounting database.
+
+        :param job_ids: List of job IDs
+        :returns: Dictionary of job IDs to states, e.g. "OUT_OF_MEMORY";
+                  jobs that `sacct` does not know are left out
+        '''
+        if not job_ids:
+            return {}
+
+        command = ['sacct', '-n', '-P', '-X', '-o', 'JobID,State',
+                   '-j', ','.join(job_ids)]
+        try:
+            output = subprocess.check_output(command)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print 'get_job_states: Error running sacct:', err
+            return {}
+
+        states = {}
+        for line in output.splitlines():
+            if '|' in line:
+                job_id, state = line.split('|', 1)
+                states[job_id] = state.split()[0] if state else 'UNKNOWN'
+
+        return states
+
+    @staticmethod
+    def get_unfinished_tasks(database, statuses):
+        '''Fetch the tasks in some states that have not completed.
+
+        :param database: Database the tasks belong to
+        :param statuses: List of states, each with a `pytunia/<state>_tasks`
+                         view, e.g. ['queued', 'started']
+        :returns: List of task documents
+        '''
+        documents = collections.OrderedDict()
+        for status in statuses:
+            rows = database.database.view('pytunia/%s_tasks' % status,
+                                          include_docs=True)
+            for row in rows:
+                document = row.doc
+                if document is not None and 'completed' not in document:
+                    documents[document.id] = document
+
+        return documents.values()
+
+    def get_outstanding_tasks(self, database):
+        '''Fetch the tasks that were claimed but have not completed.
+
+        :param database: Database the tasks belong to
+        :returns: List of task documents with a recorded job ID, or that were
+                  claimed but have neither a job ID nor started
+        '''
+        documents = SLURMCluster.get_unfinished_tasks(database,
+                                                      ['queued', 'started'])
+
+        return [document for document in documents
+                if 'job_id' in document or 'started' not in document]
+
+    @staticmethod
+    def cancel_jobs(job_ids):
+        '''Cancel SLURM jobs, all with one `scancel` call.
+
+        :param job_ids: List of job IDs
+        '''
+        if not job_ids:
+            return
+
+        try:
+            subprocess.check_call(['scancel'] + list(job_ids))
+        except (OSError, subprocess.CalledProcessError) as err:
+            print 'cancel_jobs: Error running scancel:', err
+
+    @staticmethod
+    def get_branch_key(record):
+        '''Get the key identifying the pull request or branch a record tests.
+
+        Pull requests are identified by the number in the record's changeset
+        URL, e.g. "https://github.com/snoplus/rat/pull/123". Branches are
+        identified by the record's "branch" field, if it has one, together
+        with the repository of a commit changeset URL, e.g.
+        "https://github.com/snoplus/rat/commit/<sha>".
+
+        :param record: Record document
+        :returns: Tuple of (repository URL, "pull" or "branch", number or
+                  name), or None if the branch is unknown
+        '''
+        changeset_url = record.get('changeset_url') or ''
+        match = re.search(r'^(.*)/pull/(\d+)', changeset_url)
+        if match:
+            return match.group(1), 'pull', int(match.group(2))
+
+        match = re.search(r'^(.*)/commit/', changeset_url)
+        if match and record.get('branch'):
+            return match.group(1), 'branch', record['branch']
+
+        return None
+
+    def get_branch_keys(self, database, record_ids):
+        '''Look up the branch keys of records, fetching unknown records in a
+        single request.
+
+        :param database: Database the records belong to
+        :param record_ids: List of record document IDs
+        :returns: Dictionary of record IDs to branch keys, or None where the
+                  branch is unknown
+        '''
+        unknown = [record_id for record_id in set(record_ids)
+                   if record_id is not None and
+                   record_id not in self.branch_keys]
+        found = dict((record.id, record)
+                     for record in database.get_documents(unknown))
+        for record_id in unknown:
+            record = found.get(record_id)
+            self.branch_keys[record_id] = (
+                SLURMCluster.get_branch_key(record) if record else None)
+        while len(self.branch_keys) > 1000:
+            self.branch_keys.popitem(last=False)
+
+        return dict((record_id, self.branch_keys.get(record_id))
+                    for record_id in record_ids)
+
+    def cancel_superseded(self, database, documents):
+        '''Cancel the tasks of records superseded by newly arrived ones.
+
+        When tasks of a record not seen before arrive, any unfinished tasks
+        of older records for the same pull request or branch (see
+        `get_branch_key`) are marked completed and cancelled, in one request,
+        and their jobs are cancelled with one `scancel` call. Records whose
+        branch is unknown are never superseded. Does nothing unless
+        `supersede` is set.
+
+        :param database: Database the tasks belong to
+        :param documents: List of newly fetched task documents
+        :returns: List of IDs of the cancelled tasks
+        '''
+        if not self.supersede:
+            return []
+
+        # the newest new record for each branch
+        new_records = [document.get('record_id') for document in documents
+                       if document.get('record_id') not in self.seen_records]
+        keys = self.get_branch_keys(database, new_records)
+
+        newest = {}
+        for document in documents:
+            record_id = document.get('record_id')
+            key = keys.get(record_id)
+            if key is None:
+                continue
+
+            created = document.get('created', 0)
+            if key not in newest or created > newest[key][1]:
+                newest[key] = (record_id, created)
+
+        for document in documents:
+            self.seen_records[document.get('record_id')] = True
+        while len(self.seen_records) > 1000:
+            self.seen_records.popitem(last=False)
+
+        if not newest:
+            return []
+
+        stale = []
+        statuses = ['pending', 'queued', 'started']
+        unfinished = SLURMCluster.get_unfinished_tasks(database, statuses)
+        keys = self.get_branch_keys(
+            database, [document.get('record_id') for document in unfinished])
+        for document in unfinished:
+            key = keys.get(document.get('record_id'))
+            if key is None or key not in newest:
+                continue
+
+            record_id, created = newest[key]
+            if (document.get('record_id') != record_id and
+                    document.get('created', 0) < created):
+                print 'cancel_superseded: %s is superseded by record %s' % \
+                    (document.id, record_id)
+                now = time.time()
+                document['results'] = {
+                    'success': False,
+                    'reason': 'superseded by record %s' % record_id
+                }
+                document['cancelled'] = now
+                document['completed'] = now
+                stale.append(document)
+
+        if not stale:
+            return []
+
+        # mark the tasks first, so they are not requeued once their jobs
+        # are gone; tasks that finished in the meantime keep their results
+        cancelled = []
+        job_ids = set()
+        results = database.database.update(stale)
+        for document, (success, doc_id, rev_or_exc) in zip(stale, results):
+            if success:
+                cancelled.append(doc_id)
+                if 'job_id' in document:
+                    job_ids.add(document['job_id'])
+            else:
+                print 'cancel_superseded: Error updating %s: %s' % \
+                    (doc_id, rev_or_exc)
+
+        SLURMCluster.cancel_jobs(sorted(job_ids))
+
+        return cancelled
+
+    def reconcile(self, database, grace=60, forget=None):
+        '''Find tasks whose SLURM job ended without completing them.
+
+        The SLURM queue is read with one `squeue` call and any jobs missing
+        from it are looked up with one `sacct` call. Tasks claimed without a
+        job ID, whose submission failed or whose server died before recording
+        it, are lost once the grace period passes. Lost tasks are returned to
+        the pending queue while they have requeues left, and otherwise marked
+        completed with a failed result. All changes are saved in one request.
+
+        :param database: Database the tasks belong to
+        :param grace: Ignore tasks claimed or submitted less than this many
+                      seconds ago
+        :param forget: Optional function called with the IDs of the tasks to
+                       requeue before they are returned to the pending queue,
+                       so that the caller stops tracking them first
+        :returns: List of IDs of the requeued tasks
+        '''
+        # read the queue before the tasks, so that a job that finishes in
+        # between has already saved its results
+        queued_jobs = SLURMCluster.get_queued_jobs()
+        if queued_jobs is None:
+            return []
+
+        cutoff = time.time() - grace
+        missing = []
+        for document in self.get_outstanding_tasks(database):
+            if 'job_id' not in document:
+                if document.get('queued', 0) < cutoff:
+                    missing.append(document)
+            elif (document['job_id'] not in queued_jobs and
+                  document.get('submitted', 0) < cutoff):
+                missing.append(document)
+        if not missing:
+            return []
+
+        states = SLURMCluster.get_job_states(
+            sorted(set(document['job_id'] for document in missing
+                       if 'job_id' in document)))
+
+        requeued = []
+        updates = []
+        for document in missing:
+            job_id = document.get('job_id')
+            state = states.get(job_id, 'UNKNOWN' if job_id else 'UNSUBMITTED')
+            if state in SLURMCluster.active_states:
+                continue
+
+            requeues = document.get('requeues', 0)
+            if requeues < self.max_requeues:
+                print 'reconcile: Requeueing %s (job %s %s)' % \
+                    (document.id, job_id, state)
+                for field in ('queued', 'started', 'node', 'job_id',
+                              'submitted'):
+                    document.pop(field, None)
+                document['requeues'] = requeues + 1
+                requeued.append(document.id)
+            else:
+                print 'reconcile: Failing %s (job %s %s)' % \
+                    (document.id, job_id, state)
+                if job_id is None:
+                    reason = 'SLURM job was never submitted'
+                else:
+                    reason = ('SLURM job %s ended (%s) without results' %
+                              (job_id, state))
+                document['results'] = {'success': False, 'reason': reason}
+                document['completed'] = time.time()
+
+            updates.append(document)
+
+        if not updates:
+            return []
+
+        if forget is not None:
+            forget(requeued)
+
+        results = database.database.update(updates)
+        for success, doc_id, rev_or_exc in results:
+            if not success:
+                print 'reconcile: Error updating %s: %s' % (doc_id, rev_or_exc)
+                if doc_id in requeued:
+                    requeued.remove(doc_id)
 
-        SLURMCluster.submit_job(cmd, args, partition)
+        return requeued
 
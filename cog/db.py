@@ -1,8 +1,239 @@
 '''The CouchDB interface'''
 
+import os
 import time
+import errno
+import random
+import socket
+import httplib
 import couchdb
 
+# socket errors after which a request is retried
+RETRYABLE_ERRORS = frozenset([
+    errno.EPIPE, errno.ETIMEDOUT, errno.ECONNRESET, errno.ECONNREFUSED,
+    errno.ECONNABORTED, errno.EHOSTDOWN, errno.EHOSTUNREACH,
+    errno.ENETRESET, errno.ENETUNREACH, errno.ENETDOWN
+])
+
+_session = None
+_session_pid = None
+
+def get_session():
+    '''Get the HTTP session shared by all connections in this process.
+
+    The session is configured from the environment when first used; see
+    `bin/cog`. A forked child process gets a session of its own, rather than
+    sharing its parent's open connections.
+
+    :returns: A PooledSession object
+    '''
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        pool_size = int(os.environ.get('COG_COUCHDB_POOL_SIZE', 10))
+        timeout = float(os.environ.get('COG_COUCHDB_TIMEOUT', 300))
+        retries = int(os.environ.get('COG_COUCHDB_RETRIES', 4))
+        _session = PooledSession(pool_size, timeout, retries)
+        _session_pid = os.getpid()
+
+    return _session
+
+
+class BoundedConnectionPool(couchdb.http.ConnectionPool):
+    '''A connection pool which keeps a limited number of idle connections.
+
+    Connections are kept alive and reused between requests; connections
+    released while `size` are already idle for that server are closed.
+
+    :param size: Maximum number of idle connections per server
+    :param timeout: Socket timeout, in seconds
+    '''
+    def __init__(self, size, timeout):
+        couchdb.http.ConnectionPool.__init__(self, timeout)
+        self.size = size
+
+    def release(self, url, conn):
+        scheme, host = couchdb.http.util.urlsplit(url, 'http', False)[:2]
+
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+
+        conn.close()
+
+
+class PooledSession(couchdb.http.Session):
+    '''An HTTP session with keep-alive connections and retries.
+
+    Requests which fail with a connection error or a 5xx response are retried
+    after an exponentially growing, randomly jittered delay, so that many jobs
+    failing at once do not all retry in step. A streamed request body is only
+    retried if it can be rewound with `seek`.
+
+    Conflicts (409) are not retried here: resending the same revision would
+    conflict again, so callers must resolve them against the latest revision.
+
+    :param pool_size: Maximum number of idle connections to keep
+    :param timeout: Socket timeout, in seconds
+    :param retries: Number of times to retry a failed request
+    :param backoff: Upper bound on the first retry delay, in seconds
+    '''
+    def __init__(self, pool_size=10, timeout=None, retries=4, backoff=0.5):
+        # couchdb's own retries resend streamed bodies without rewinding
+        # them, so all retries are done in `request` instead
+        couchdb.http.Session.__init__(self, timeout=timeout,
+                                      retryable_errors=[])
+        self.connection_pool = BoundedConnectionPool(pool_size, timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+    def retry_delay(self, attempt):
+        '''Choose how long to wait before retrying a request.
+
+        :param attempt: Number of attempts made so far
+        :returns: The delay in seconds
+        '''
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+    @staticmethod
+    def is_retryable(error):
+        '''Check whether a failed request should be retried.
+
+        :param error: The exception raised by the request
+        :returns: True if the error is transient
+        '''
+        if isinstance(error, socket.error):
+            return error.args and error.args[0] in RETRYABLE_ERRORS
+
+        if isinstance(error, couchdb.http.ServerError):
+            if error.args and isinstance(error.args[0], tuple):
+                return error.args[0][0] >= 500
+
+        return False
+
+    def request(self, method, url, body=None, headers=None, credentials=None,
+                num_redirects=0):
+        attempt = 0
+
+        while True:
+            try:
+                return couchdb.http.Session.request(self, method, url, body,
+                                                    headers, credentials,
+                                                    num_redirects)
+            except (socket.error, couchdb.http.ServerError) as e:
+                attempt += 1
+                streamed = body is not None and hasattr(body, 'read')
+
+                if (attempt > self.retries or not self.is_retryable(e) or
+                        (streamed and not hasattr(body, 'seek'))):
+                    raise
+
+                print 'PooledSession: %s %s failed (%s), retrying' % \
+                    (method, url, e)
+                time.sleep(self.retry_delay(attempt))
+
+                if streamed:
+                    body.seek(0)
+
+    def put_stream(self, url, body, length, headers=None, credentials=None):
+        '''PUT a streamed body of known length, without chunked encoding.
+
+        `request` sends any file-like body with "Transfer-Encoding: chunked",
+        which CouchDB 1.x cannot read in a multipart/related document update.
+        This sends a Content-Length instead, over the same pooled connections
+        and with the same retries.
+
+        :param url: The URL to PUT to
+        :param body: File-like body with `read` and `seek`
+        :param length: Total length of the body, in bytes
+        :param headers: Dictionary of extra headers
+        :param credentials: A (username, password) tuple, or None
+        :returns: The decoded JSON response
+        :raises: The couchdb.http exception matching an error response
+        '''
+        headers = dict(headers or {})
+        headers['Content-Length'] = str(length)
+        headers.setdefault('Accept', 'application/json')
+        authorization = couchdb.http.basic_auth(credentials)
+        if authorization:
+            headers['Authorization'] = authorization
+
+        util = couchdb.http.util
+        path = util.urlunsplit(('', '') + util.urlsplit(url)[2:4] + ('',))
+
+        attempt = 0
+        while True:
+            try:
+                return self.try_put_stream(url, path, body, headers)
+            except (socket.error, couchdb.http.ServerError) as e:
+                attempt += 1
+                if attempt > self.retries or not self.is_retryable(e):
+                    raise
+
+                print 'PooledSession: PUT %s failed (%s), retrying' % (url, e)
+                time.sleep(self.retry_delay(attempt))
+                body.seek(0)
+
+    def try_put_stream(self, url, path, body, headers):
+        '''Make one attempt at a `put_stream` request.
+
+        :param url: The URL to PUT to
+        :param path: The path and query of the URL
+        :param body: File-like body
+        :param headers: Dictionary of headers
+        :returns: The decoded JSON response
+        '''
+        conn = self.connection_pool.get(url)
+        try:
+            conn.putrequest('PUT', path, skip_accept_encoding=True)
+            for header, value in headers.items():
+                conn.putheader(header, value)
+            conn.endheaders()
+
+            while True:
+                chunk = body.read(couchdb.http.CHUNK_SIZE)
+                if not chunk:
+                    break
+                conn.send(chunk)
+
+            resp = conn.getresponse()
+            data = resp.read()
+        except httplib.HTTPException:
+            # as in couchdb.http, a keep-alive connection the server closed
+            # shows up as BadStatusLine; make it retryable
+            conn.close()
+            raise socket.error(errno.ECONNRESET, 'connection reset by peer')
+        except Exception:
+            conn.close()
+            raise
+
+        self.connection_pool.release(url, conn)
+
+        try:
+            data = couchdb.json.decode(data.decode('utf-8'))
+        except ValueError:
+            data = {'error': 'unknown', 'reason': data}
+
+        status = resp.status
+        if status < 400:
+            return data
+
+        error = data.get('error'), data.get('reason')
+        exceptions = {
+            401: couchdb.http.Unauthorized,
+            403: couchdb.http.Forbidden,
+            404: couchdb.http.ResourceNotFound,
+            409: couchdb.http.ResourceConflict,
+            412: couchdb.http.PreconditionFailed
+        }
+        if status in exceptions:
+            raise exceptions[status](error)
+
+        raise couchdb.http.ServerError((status, error))
+
+
 class CouchDB(object):
     '''Interface to a CouchDB database.
 
@@ -13,6 +244,9 @@ class CouchDB(object):
     :param username: CouchDB username
     :param password: CouchDB password
     '''
+    # local (non-replicated) document holding the changes feed position
+    checkpoint_id = '_local/cog_changes'
+
     def __init__(self, host, dbname, username=None, password=None):
         self.host = host
         self.dbname = dbname
@@ -21,6 +255,7 @@ class CouchDB(object):
 
         self.database = CouchDB.connect(self.host, self.dbname,
                                         self.username, self.password)
+        self.checkpoint = None
 
     @staticmethod
     def connect(host, dbname, username, password):
@@ -31,30 +266,182 @@ class CouchDB(object):
         :param credentials: A (username, password) tuple
         :returns: A couchdb.client.Database object
         '''
-        couch = couchdb.Server(host)
+        couch = couchdb.Server(host, session=get_session())
  
         if username is not None and password is not None:
             couch.resource.credentials = (username, password)
  
         return couch[dbname]
 
-    def get_tasks(self):
-        '''Watch the changes feed for new tasks.
- 
+    @staticmethod
+    def is_pending(document):
+        '''Check whether a task document is still waiting to be run.
+
+        A task is pending until it is queued, which is the same state that
+        `bin/restart.py` resets documents to.
+
+        :param document: The task document
+        :returns: True if the task has not been queued, started or completed
+        '''
+        if document.get('type') != 'task':
+            return False
+
+        for field in ('queued', 'started', 'completed'):
+            if field in document:
+                return False
+
+        return True
+
+    def get_documents(self, doc_ids):
+        '''Fetch several documents in a single request.
+
+        :param doc_ids: List of document IDs
+        :returns: List of couchdb.client.Document objects, skipping any that
+                  do not exist or were deleted
+        '''
+        if not doc_ids:
+            return []
+
+        rows = self.database.view('_all_docs', keys=list(doc_ids),
+                                  include_docs=True)
+
+        return [row.doc for row in rows if row.doc is not None]
+
+    def get_tasks(self, follow_changes=False):
+        '''Watch the database for new tasks.
+
+        By default the pending tasks view is rescanned every minute. If
+        `follow_changes` is set, the view is scanned once and the changes feed
+        is followed from there on; see `follow_tasks`.
+
+        :param follow_changes: Follow the changes feed instead of polling
         :returns: Generator of changed document IDs
         '''
- 
+        for batch in self.get_task_batches(follow_changes):
+            for doc_id in batch:
+                yield doc_id
+
+    def get_task_batches(self, follow_changes=False):
+        '''Watch the database for new tasks, grouped by arrival.
+
+        Like `get_tasks`, but each item is the list of task IDs found by one
+        view scan or one changes feed wake-up.
+
+        :param follow_changes: Follow the changes feed instead of polling
+        :returns: Generator of lists of changed document IDs
+        '''
+        if follow_changes:
+            return self.follow_tasks()
+
+        return self.poll_tasks()
+
+    def scan_tasks(self):
+        '''Query the pending tasks view once.
+
+        :returns: List of pending task document IDs
+        '''
+        doc_ids = []
+        rows = self.database.view('pytunia/pending_tasks')
+        try:
+            for row in rows:
+                doc_ids.append(row.id)
+
+        except couchdb.http.ResourceNotFound:
+            print 'scan_tasks: Caught couchdb.http.ResourceNotFound'
+
+        except ValueError as e:
+            print 'scan_tasks: Caught ValueError:', e
+
+        return doc_ids
+
+    def poll_tasks(self, interval=60):
+        '''Rescan the pending tasks view at a fixed interval.
+
+        :param interval: Time between passes, in seconds
+        :returns: Generator of lists of pending document IDs
+        '''
+        while True:
+            yield self.scan_tasks()
+
+            time.sleep(interval)
+
+    def follow_tasks(self, timeout=60):
+        '''Follow the changes feed for new tasks.
+
+        The pending tasks view is scanned once on startup, to catch anything
+        posted while the server was down. After that, the changes feed
+        (filtered with `pytunia/task`) is followed in longpoll mode, so new
+        tasks are seen as soon as they are posted and every wake-up only
+        carries the documents that changed. The feed position is checkpointed
+        in the database after each batch, and resumed from on restart.
+
+        :param timeout: Longpoll timeout, in seconds
+        :returns: Generator of lists of pending document IDs, which may be
+                  empty
+        '''
+        since = self.get_checkpoint()
+        if since is None:
+            since = self.database.info()['update_seq']
+
+        yield self.scan_tasks()
+
         while True:
-            rows = self.database.view('pytunia/pending_tasks')
             try:
-                for row in rows:
-                    yield row.id
- 
+                changes = self.database.changes(feed='longpoll', since=since,
+                                                filter='pytunia/task',
+                                                include_docs=True,
+                                                timeout=timeout * 1000)
+
             except couchdb.http.ResourceNotFound:
-                print 'get_tasks: Caught couchdb.http.ResourceNotFound'
+                print 'follow_tasks: Caught couchdb.http.ResourceNotFound'
+                time.sleep(timeout)
+                continue
+
+            except (couchdb.http.ServerError, socket.error) as e:
+                print 'follow_tasks: Error reading changes feed:', e
+                time.sleep(timeout)
+                continue
+
+            doc_ids = []
+            for change in changes['results']:
+                document = change.get('doc')
+                if change.get('deleted') or document is None:
+                    continue
+
+                if CouchDB.is_pending(document):
+                    doc_ids.append(change['id'])
+
+            # yield even when there is nothing new, so that the consumer
+            # gets a chance to do periodic work
+            yield doc_ids
 
-	    except ValueError as e:
-                print 'get_tasks: Caught ValueError:', e
+            if changes['last_seq'] != since:
+                since = changes['last_seq']
+                self.set_checkpoint(since)
 
-            time.sleep(60)
+    def get_checkpoint(self):
+        '''Get the stored changes feed position.
+
+        :returns: The last processed update sequence, or None
+        '''
+        self.checkpoint = self.database.get(CouchDB.checkpoint_id)
+        if self.checkpoint is None:
+            return None
+
+        return self.checkpoint.get('since')
+
+    def set_checkpoint(self, since):
+        '''Store the changes feed position.
+
+        :param since: The last processed update sequence
+        '''
+        if self.checkpoint is None:
+            self.checkpoint = {'_id': CouchDB.checkpoint_id}
+        self.checkpoint['since'] = since
 
+        try:
+            self.database.save(self.checkpoint)
+        except couchdb.http.ResourceConflict:
+            # another server moved it; pick up its revision next time
+            print 'set_checkpoint: Caught couchdb.http.ResourceConflict'
+            self.checkpoint = self.database.get(CouchDB.checkpoint_id)
@@ -1,17 +1,635 @@
 '''Main server functions and event loop.'''
 
-def serve_forever(database, cluster):
+import time
+import Queue
+import inspect
+import importlib
+import threading
+import collections
+import couchdb
+import cog.db
+import cog.task
+
+class DispatchLedger(object):
+    '''Record of the tasks this server has submitted.
+
+    Task IDs are remembered from submission until `prune` finds that the task
+    has started or completed (or was reset for a rerun), so a task that is
+    returned again by the pending view is not resubmitted. The ledger is
+    bounded; if it is full of tasks that are all still queued, the oldest
+    entries are dropped.
+
+    :param maxlen: Maximum number of task IDs to remember
+    '''
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, doc_id):
+        return doc_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, doc_id):
+        '''Record a submitted task.
+
+        :param doc_id: The task document ID
+        '''
+        self.entries[doc_id] = time.time()
+
+        while len(self.entries) > self.maxlen:
+            self.entries.popitem(last=False)
+
+    def discard(self, doc_id):
+        '''Forget a task.
+
+        :param doc_id: The task document ID
+        '''
+        self.entries.pop(doc_id, None)
+
+    def prune(self, database):
+        '''Evict tasks which are no longer waiting in the queue.
+
+        All remembered documents are fetched in a single request.
+
+        :param database: cog.db.CouchDB object the tasks belong to
+        '''
+        if not self.entries:
+            return
+
+        rows = database.database.view('_all_docs', keys=list(self.entries),
+                                      include_docs=True)
+        for row in rows:
+            document = row.doc
+            if (document is None or 'started' in document or
+                    'completed' in document or 'queued' not in document):
+                self.discard(row.key)
+
+
+class Scheduler(object):
+    '''Chooses the order in which pending tasks are submitted.
+
+    Fetched tasks wait in a backlog until `select` picks them. Tasks are taken
+    in order of priority, lowest value first, as given per task name by the
+    `priorities` map (with the key 'default' for any other task, and 0 if no
+    value applies). Within a priority, records take turns, starting with
+    those that have the fewest tasks in flight, so one record with many tasks
+    cannot hold up the quick checks of the next.
+
+    Up to `max_in_flight` tasks in total and `max_per_record` per record may
+    be submitted but not completed at once; further tasks wait in the backlog
+    until `prune` finds running ones completed.
+
+    The scheduler may be shared between threads.
+
+    :param priorities: A map of task names to priorities
+    :param max_in_flight: Maximum number of tasks in flight, or None
+    :param max_per_record: Maximum number of tasks in flight per record, or
+                           None
+    '''
+    def __init__(self, priorities=None, max_in_flight=None,
+                 max_per_record=None):
+        self.priorities = priorities or {}
+        self.max_in_flight = max_in_flight
+        self.max_per_record = max_per_record
+
+        self.backlog = collections.OrderedDict()  # IDs to documents
+        self.in_flight = collections.OrderedDict()  # IDs to record IDs
+        self.lock = threading.Lock()
+
+    def __contains__(self, doc_id):
+        with self.lock:
+            return doc_id in self.backlog or doc_id in self.in_flight
+
+    def is_in_flight(self, doc_id):
+        '''Check whether a task has been selected and not yet released.
+
+        :param doc_id: Task document ID
+        :returns: True if the task is in flight
+        '''
+        with self.lock:
+            return doc_id in self.in_flight
+
+    def get_priority(self, document):
+        '''Get the priority of a task.
+
+        :param document: Document defining the task
+        :returns: The priority; lower values are submitted first
+        '''
+        name = document.get('name')
+        return self.priorities.get(name, self.priorities.get('default', 0))
+
+    def add(self, documents):
+        '''Add fetched tasks to the backlog.
+
+        A task already waiting in the backlog is replaced, so that the latest
+        revision of a task which changed while it waited is the one claimed,
+        or dropped if it is no longer pending.
+
+        :param documents: List of task documents
+        '''
+        with self.lock:
+            for document in documents:
+                if document.id in self.in_flight:
+                    continue
+                if cog.db.CouchDB.is_pending(document):
+                    self.backlog[document.id] = document
+                else:
+                    self.backlog.pop(document.id, None)
+
+    def select(self):
+        '''Take the next tasks to submit out of the backlog.
+
+        The chosen tasks count as in flight until they are released or
+        pruned.
+
+        :returns: List of task documents, in the order to submit them
+        '''
+        with self.lock:
+            counts = collections.Counter(self.in_flight.values())
+            capacity = len(self.backlog)
+            if self.max_in_flight is not None:
+                capacity = min(capacity,
+                               self.max_in_flight - len(self.in_flight))
+
+            # backlog, by priority then record, in order of arrival
+            levels = {}
+            for document in self.backlog.values():
+                records = levels.setdefault(self.get_priority(document),
+                                            collections.OrderedDict())
+                record_id = document.get('record_id')
+                records.setdefault(record_id, collections.deque()).append(
+                    document)
+
+            chosen = []
+            for priority in sorted(levels):
+                records = levels[priority]
+                while records and len(chosen) < capacity:
+                    for record_id in sorted(records, key=lambda r: counts[r]):
+                        if len(chosen) >= capacity:
+                            break
+
+                        if (self.max_per_record is not None and
+                                counts[record_id] >= self.max_per_record):
+                            del records[record_id]
+                            continue
+
+                        document = records[record_id].popleft()
+                        chosen.append(document)
+                        counts[record_id] += 1
+
+                        if not records[record_id]:
+                            del records[record_id]
+
+            for document in chosen:
+                del self.backlog[document.id]
+                self.in_flight[document.id] = document.get('record_id')
+
+            return chosen
+
+    def release(self, doc_ids):
+        '''Stop counting selected tasks that were not submitted.
+
+        :param doc_ids: List of task document IDs
+        '''
+        with self.lock:
+            for doc_id in doc_ids:
+                self.in_flight.pop(doc_id, None)
+
+    def discard(self, doc_ids):
+        '''Forget tasks, whether waiting in the backlog or in flight.
+
+        :param doc_ids: List of task document IDs
+        '''
+        with self.lock:
+            for doc_id in doc_ids:
+                self.backlog.pop(doc_id, None)
+                self.in_flight.pop(doc_id, None)
+
+    def prune(self, database):
+        '''Stop counting tasks which have completed.
+
+        Tasks which were deleted or returned to the pending queue are dropped
+        too. All in-flight documents are fetched in a single request.
+
+        :param database: cog.db.CouchDB object the tasks belong to
+        '''
+        with self.lock:
+            doc_ids = list(self.in_flight)
+
+        if not doc_ids:
+            return
+
+        finished = []
+        for row in database.database.view('_all_docs', keys=doc_ids,
+                                          include_docs=True):
+            document = row.doc
+            if (document is None or 'completed' in document or
+                    'queued' not in document):
+                finished.append(row.key)
+
+        self.release(finished)
+
+
+class ResultCache(object):
+    '''Completes tasks with the results of identical earlier tasks, without
+    submitting them to the cluster.
+
+    A task can be completed this way if its task class caches results and
+    a completed task with the same input key exists (see
+    `cog.task.Task.get_input_key`). Unlike the check a task makes when it
+    runs, the versions of the tools on the compute nodes are not compared.
+    Trees are resolved against git mirrors on the server host.
+
+    :param cache_dir: Directory holding the git mirrors
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.task_classes = {}
+
+    def get_task_class(self, name):
+        '''Find the class implementing a task.
+
+        :param name: Name of the task module in `cog.tasks`
+        :returns: The cog.task.Task subclass, or None
+        '''
+        if name not in self.task_classes:
+            self.task_classes[name] = None
+            try:
+                module = importlib.import_module('cog.tasks.' + name)
+            except ImportError as e:
+                print 'get_task_class: Cannot import %s: %s' % (name, e)
+                return None
+
+            for value in vars(module).values():
+                if (inspect.isclass(value) and
+                        issubclass(value, cog.task.Task) and
+                        value.__module__ == module.__name__):
+                    self.task_classes[name] = value
+
+        return self.task_classes[name]
+
+    def complete(self, database, documents):
+        '''Complete the tasks whose results are already known.
+
+        :param database: cog.db.CouchDB object the tasks belong to
+        :param documents: List of pending task documents
+        :returns: List of the documents that still need to be run
+        '''
+        remaining = []
+        for document in documents:
+            task_class = self.get_task_class(document.get('name'))
+            if task_class is None or not task_class.cache_results:
+                remaining.append(document)
+                continue
+
+            try:
+                key = task_class.get_input_key(document, self.cache_dir)
+                source = cog.task.find_cached_result(database.database, key,
+                                                     document.id)
+                if source is None:
+                    remaining.append(document)
+                    continue
+
+                print 'complete: Reusing the results of %s for %s' % \
+                    (source.id, document.id)
+                cog.task.complete_from_cache(database.database, document,
+                                             source, {'input_key': key})
+            except couchdb.http.ResourceConflict:
+                print 'complete: %s was already completed' % document.id
+            except Exception as e:
+                print 'complete: Error looking up cached results:', e
+                remaining.append(document)
+
+        return remaining
+
+
+def serve_forever(database, cluster, follow_changes=False,
+                  prune_interval=60, reconcile_interval=300, scheduler=None,
+                  result_cache=None):
     '''Run the server.
 
     Watch the changes feed of `database` for new tasks, and start them running
-    on the cluster.
+    on the cluster, in the order chosen by `scheduler`.
 
     :param database: couchdb.client.Database object to watch
     :param cluster: Cluster object defining the cluster to run jobs on
+    :param follow_changes: Follow the changes feed instead of polling
+    :param prune_interval: Time between ledger prunes, in seconds
+    :param reconcile_interval: Time between checks for lost jobs, in seconds
+    :param scheduler: Scheduler object, or None to submit tasks as they come
+    :param result_cache: ResultCache object, or None to submit every task
     '''
-    tasks = database.get_tasks()  # infinite generator
+    batches = database.get_task_batches(follow_changes)  # infinite generator
+    ledger = DispatchLedger()
+    scheduler = scheduler or Scheduler()
+    last_prune = time.time()
+    last_reconcile = time.time()
+
+    for batch in batches:
+        # errors talking to the database or SLURM skip that step for this
+        # batch rather than stopping the server
+        if time.time() - last_prune > prune_interval:
+            try:
+                ledger.prune(database)
+                scheduler.prune(database)
+            except Exception as e:
+                print 'serve_forever: Error pruning ledger:', e
+            last_prune = time.time()
+
+        if time.time() - last_reconcile > reconcile_interval:
+            try:
+                for doc_id in cluster.reconcile(database):
+                    ledger.discard(doc_id)
+                    scheduler.discard([doc_id])
+            except Exception as e:
+                print 'serve_forever: Error reconciling jobs:', e
+            last_reconcile = time.time()
+
+        doc_ids = [doc_id for doc_id in batch
+                   if doc_id not in ledger and
+                   not scheduler.is_in_flight(doc_id)]
+        for doc_id in doc_ids:
+            print doc_id
+
+        try:
+            documents = database.get_documents(doc_ids)
+        except Exception as e:
+            print 'serve_forever: Error fetching tasks:', e
+            documents = []
+
+        try:
+            cancelled = set(cluster.cancel_superseded(database, documents))
+            scheduler.discard(cancelled)
+            documents = [d for d in documents if d.id not in cancelled]
+        except Exception as e:
+            print 'serve_forever: Error cancelling superseded tasks:', e
+
+        if result_cache is not None:
+            try:
+                documents = result_cache.complete(database, documents)
+            except Exception as e:
+                print 'serve_forever: Error completing cached tasks:', e
+
+        scheduler.add(documents)
+        documents = scheduler.select()
+
+        submitted = []
+        try:
+            submitted = cluster.submit_tasks(database, documents)
+        except Exception as e:
+            print 'serve_forever: Error submitting tasks:', e
+
+        for doc_id in submitted:
+            ledger.add(doc_id)
+
+        scheduler.release(set(d.id for d in documents) - set(submitted))
+
+
+class Dispatcher(object):
+    '''A concurrent task dispatcher.
+
+    Reading the task feed, fetching task documents and submitting jobs each
+    run in their own threads, connected by bounded queues, so a slow CouchDB
+    request or a hung `sbatch` only holds up its own stage. When a queue is
+    full the stage feeding it blocks, which throttles the stages upstream
+    rather than buffering without limit. Pruning the dispatch ledger and
+    reconciling lost jobs run periodically in threads of their own.
+
+    Errors reading the task feed restart it after a delay. If any thread
+    exits unexpectedly, the dispatcher stops, so that the server exits and
+    can be restarted by whatever supervises it.
+
+    :param database: cog.db.CouchDB object to watch
+    :param cluster: Cluster object defining the cluster to run jobs on
+    :param follow_changes: Follow the changes feed instead of polling
+    :param submitters: Number of threads submitting jobs
+    :param queue_size: Number of batches each queue between stages holds
+    :param prune_interval: Time between ledger prunes, in seconds
+    :param reconcile_interval: Time between checks for lost jobs, in seconds
+    :param scheduler: Scheduler object, or None to submit tasks as they come
+    :param result_cache: ResultCache object, or None to submit every task
+    :param feed_retry_delay: Time to wait before restarting the task feed
+                             after an error, in seconds
+    '''
+    def __init__(self, database, cluster, follow_changes=False, submitters=4,
+                 queue_size=16, prune_interval=60, reconcile_interval=300,
+                 scheduler=None, result_cache=None, feed_retry_delay=10):
+        self.database = database
+        self.cluster = cluster
+        self.follow_changes = follow_changes
+        self.submitters = submitters
+        self.prune_interval = prune_interval
+        self.reconcile_interval = reconcile_interval
+        self.feed_retry_delay = feed_retry_delay
+
+        self.ledger = DispatchLedger()
+        self.scheduler = scheduler or Scheduler()
+        self.result_cache = result_cache
+        self.in_flight = set()  # read from the feed but not yet scheduled
+        self.lock = threading.Lock()  # guards the ledger and in_flight
+
+        self.batches = Queue.Queue(queue_size)  # lists of task IDs
+        self.documents = Queue.Queue(queue_size)  # lists of task documents
+
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        '''Start the dispatcher threads.'''
+        targets = [self.read_feed, self.fetch_documents, self.prune_ledger,
+                   self.reconcile_jobs]
+        targets += [self.submit_tasks] * self.submitters
+
+        for target in targets:
+            thread = threading.Thread(target=target, name=target.__name__)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        '''Ask the dispatcher threads to exit.
+
+        Threads blocked on a queue or the task feed exit once they wake up.
+        '''
+        self.stopping.set()
+
+    def wait(self):
+        '''Block until the dispatcher is stopped.
+
+        :returns: False if a thread exited unexpectedly, which stops the
+                  dispatcher, otherwise True
+        '''
+        while not self.stopping.is_set():
+            self.stopping.wait(1)
+
+            for thread in self.threads:
+                if not thread.is_alive() and not self.stopping.is_set():
+                    print 'wait: Thread %s exited, stopping' % thread.name
+                    self.stop()
+                    return False
 
-    for doc_id in tasks:
-        print doc_id
-        cluster.submit_task(database, database.database[doc_id])
+        return True
 
+    def release(self, doc_ids):
+        '''Mark tasks as no longer in flight.
+
+        :param doc_ids: List of task document IDs
+        '''
+        with self.lock:
+            self.in_flight.difference_update(doc_ids)
+
+    def read_feed(self):
+        '''Queue new task IDs from the task feed, restarting it on errors.'''
+        while not self.stopping.is_set():
+            try:
+                self.follow_feed()
+            except Exception as e:
+                print 'read_feed: Error reading task feed:', e
+                self.stopping.wait(self.feed_retry_delay)
+
+    def follow_feed(self):
+        '''Queue new task IDs from the task feed until stopped.'''
+        for batch in self.database.get_task_batches(self.follow_changes):
+            if self.stopping.is_set():
+                return
+
+            with self.lock:
+                doc_ids = [doc_id for doc_id in batch
+                           if doc_id not in self.ledger and
+                           doc_id not in self.in_flight and
+                           not self.scheduler.is_in_flight(doc_id)]
+                self.in_flight.update(doc_ids)
+
+            if doc_ids:
+                self.batches.put(doc_ids)
+
+    def fetch_documents(self):
+        '''Fetch the documents for queued task IDs.'''
+        while not self.stopping.is_set():
+            doc_ids = self.batches.get()
+            for doc_id in doc_ids:
+                print doc_id
+
+            try:
+                documents = self.database.get_documents(doc_ids)
+            except Exception as e:
+                print 'fetch_documents: Error fetching tasks:', e
+                self.release(doc_ids)
+                continue
+
+            try:
+                cancelled = set(self.cluster.cancel_superseded(self.database,
+                                                               documents))
+                self.scheduler.discard(cancelled)
+                documents = [d for d in documents if d.id not in cancelled]
+            except Exception as e:
+                print 'fetch_documents: Error cancelling superseded tasks:', e
+
+            if self.result_cache is not None:
+                documents = self.result_cache.complete(self.database,
+                                                       documents)
+
+            self.scheduler.add(documents)
+            self.release(doc_ids)
+            self.schedule()
+
+    def schedule(self):
+        '''Queue the tasks chosen by the scheduler for submission.'''
+        documents = self.scheduler.select()
+        if documents:
+            self.documents.put(documents)
+
+    def submit_tasks(self):
+        '''Submit fetched tasks to the cluster.'''
+        while not self.stopping.is_set():
+            documents = self.documents.get()
+
+            submitted = []
+            try:
+                submitted = self.cluster.submit_tasks(self.database,
+                                                      documents)
+            except Exception as e:
+                print 'submit_tasks: Error submitting tasks:', e
+
+            with self.lock:
+                for doc_id in submitted:
+                    self.ledger.add(doc_id)
+
+            self.scheduler.release(set(d.id for d in documents) -
+                                   set(submitted))
+
+    def prune_ledger(self):
+        '''Periodically evict finished tasks from the ledger.'''
+        while not self.stopping.wait(self.prune_interval):
+            with self.lock:
+                doc_ids = list(self.ledger.entries)
+
+            pruned = DispatchLedger(maxlen=self.ledger.maxlen)
+            for doc_id in doc_ids:
+                pruned.add(doc_id)
+
+            try:
+                pruned.prune(self.database)
+            except Exception as e:
+                print 'prune_ledger: Error pruning ledger:', e
+                continue
+
+            with self.lock:
+                for doc_id in doc_ids:
+                    if doc_id not in pruned:
+                        self.ledger.discard(doc_id)
+
+            # completed tasks make room for more
+            try:
+                self.scheduler.prune(self.database)
+            except Exception as e:
+                print 'prune_ledger: Error pruning scheduler:', e
+                continue
+
+            self.schedule()
+
+    def reconcile_jobs(self):
+        '''Periodically requeue or fail tasks whose jobs were lost.'''
+        while not self.stopping.wait(self.reconcile_interval):
+            try:
+                self.cluster.reconcile(self.database, forget=self.forget)
+            except Exception as e:
+                print 'reconcile_jobs: Error reconciling jobs:', e
+
+    def forget(self, doc_ids):
+        '''Stop tracking tasks, so they are dispatched again if they return.
+
+        Called before the tasks are returned to the pending queue, so that
+        the change feed cannot deliver them while they are still tracked.
+
+        :param doc_ids: List of task document IDs
+        '''
+        with self.lock:
+            for doc_id in doc_ids:
+                self.ledger.discard(doc_id)
+        self.scheduler.discard(doc_ids)
+
+
+def serve_concurrent(database, cluster, follow_changes=False, submitters=4,
+                     queue_size=16, scheduler=None, result_cache=None):
+    '''Run the server with a concurrent dispatcher.
+
+    Like `serve_forever`, but the stages of dispatch run in parallel; see
+    `Dispatcher`.
+
+    :param database: cog.db.CouchDB object to watch
+    :param cluster: Cluster object defining the cluster to run jobs on
+    :param follow_changes: Follow the changes feed instead of polling
+    :param submitters: Number of threads submitting jobs
+    :param queue_size: Number of batches each queue between stages holds
+    :param scheduler: Scheduler object, or None to submit tasks as they come
+    :param result_cache: ResultCache object, or None to submit every task
+    '''
+    dispatcher = Dispatcher(database, cluster, follow_changes, submitters,
+                            queue_size, scheduler=scheduler,
+                            result_cache=result_cache)
+    dispatcher.start()
+    if not dispatcher.wait():
+        raise RuntimeError('dispatcher thread exited unexpectedly')
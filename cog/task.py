@@ -1,13 +1,51 @@
 '''Structures and helper utilities for tasks.'''
 
 import os
+import copy
+import re
+import gzip
+import json
 import time
+import uuid
+import fcntl
+import functools
 import socket
+import hashlib
+import inspect
+import StringIO
 import subprocess
+import mimetypes
+import collections
+import multiprocessing
 import tempfile
 import shutil
+import couchdb
 import cog.db
 
+# Node-local cache of bare repository mirrors used as clone references.
+# Disabled unless COG_GIT_CACHE is set; mirrors older than
+# COG_GIT_CACHE_MAX_AGE seconds are fetched before use.
+GIT_CACHE_DIR = os.environ.get('COG_GIT_CACHE')
+GIT_CACHE_MAX_AGE = float(os.environ.get('COG_GIT_CACHE_MAX_AGE', 300))
+
+# Node-local cache of compiled trees, keyed by source tree and build
+# settings. Disabled unless COG_BUILD_CACHE is set.
+BUILD_CACHE_DIR = os.environ.get('COG_BUILD_CACHE')
+
+# Environment variables that can change the result of a build
+BUILD_ENV_VARS = ['PATH', 'LD_LIBRARY_PATH', 'PYTHONPATH', 'CC', 'CXX',
+                  'CFLAGS', 'CXXFLAGS', 'LDFLAGS', 'ROOTSYS', 'G4INSTALL',
+                  'G4SYSTEM']
+
+# Files in a build tree that are not published to the build cache, because
+# they are specific to one checkout (env.* are rewritten by ./configure)
+BUILD_CACHE_EXCLUDE = ['.git', 'clone.log', 'env.sh', 'env.csh']
+
+# Node-local cache of static analysis results (include indexes, base branch
+# baselines, ...), keyed by content. Disabled unless COG_ANALYSIS_CACHE is
+# set.
+ANALYSIS_CACHE_DIR = os.environ.get('COG_ANALYSIS_CACHE')
+
 class Task(object):
     '''Scaffolding for defining tasks.
 
@@ -18,8 +56,19 @@ class Task(object):
     :param dbname: CouchDB database name
     :param username: Database username
     :param password: Database password
-    :param doc_id: Document ID of the task to run
+    :param doc_id: Document ID of the task to run, or "@" and the path to a
+                   job array manifest (see `resolve_doc_id`)
     '''
+    # How much of the repository the task needs (see `strategy_clone`).
+    # None means a full clone.
+    clone_strategy = None
+
+    # Whether the results can be reused by another task with the same inputs
+    # (see `get_input_key`), and commands that print the versions of the
+    # tools the task runs.
+    cache_results = False
+    tool_versions = []
+
     def __init__(self, *args):
         # Check if arguments are passed and attempt to unpack the arguments if so.
         # If not, do not initialize CouchDB and set all related attributes to None.
@@ -29,7 +78,7 @@ class Task(object):
 
             self.couchdb = cog.db.CouchDB(host, dbname, username, password)
             self.database = self.couchdb.database
-            self.document = self.database[doc_id]
+            self.document = self.database[resolve_doc_id(doc_id)]
 
         else:
             self.couchdb = None
@@ -37,10 +86,31 @@ class Task(object):
             self.document = None
 
         self.work_dir = tempfile.mkdtemp()  # working directory
+        self.cache_keys = {}  # input_key and result_key, if known
 
     def __call__(self, clone=True, build=True):
-        '''Run the task and update the database.'''
+        '''Run the task and update the database.
+
+        If an identical task already has results, they are copied instead.
+        '''
         self.start()
+
+        try:
+            input_key = type(self).get_input_key(self.document)
+            result_key = self.get_result_key(input_key)
+            if result_key is not None:
+                self.cache_keys = {'input_key': input_key,
+                                   'result_key': result_key}
+            cached = find_cached_result(self.database, result_key,
+                                        self.document.id)
+        except Exception as e:
+            print 'Task: Error looking up cached results:', e
+            cached = None
+
+        if cached is not None:
+            self.finish_cached(cached)
+            return
+
         try:
             results = self.run(self.document, self.work_dir)
         except Exception as e:
@@ -57,43 +127,220 @@ class Task(object):
             print 'Task.__del__: Error removing temporary working directory'
 
     def start(self):
-        '''Update the database to indicate that the task has started.'''
+        '''Update the database to indicate that the task has started.
+
+        The server may still be recording the job ID on the document when the
+        task starts, so a conflicting save is retried on the latest revision.
+        '''
         self.document['started'] = time.time()
         self.document['node'] = socket.getfqdn()
-        self.database.save(self.document)
-        self.document = self.database[self.document.id]
+
+        try:
+            self.database.save(self.document)  # updates the _rev in place
+        except couchdb.http.ResourceConflict:
+            print 'Task.start: Caught couchdb.http.ResourceConflict, retrying'
+            document = self.database[self.document.id]
+            document['started'] = self.document['started']
+            document['node'] = self.document['node']
+            self.document = document
+            self.database.save(self.document)
 
     def finish(self, results):
         '''Update the database with results when task is finished.
 
-        :param results: Dictionary of task results
-        '''
-        # upload attachments
-        if 'attachments' in results:
-            for attachment in results['attachments']:
-                self.database.put_attachment(self.document,
-                                             attachment['contents'],
-                                             filename=attachment['filename'])
-            self.document = self.database[self.document.id]
+        The results, links to attachments, completion time and the
+        attachments themselves are written in a single request (see
+        `save_with_attachments`), so the document is never seen half
+        finished.
 
-        self.document['results'] = results
+        :param results: Dictionary of task results; see `attachment_part`
+                        for the format of any 'attachments'
+        '''
+        attachments = results.pop('attachments', None)
 
-        if 'attachments' in results:
-            for attachment in results['attachments']:
+        if attachments is not None:
+            for attachment in attachments:
                 # if a link name is specified, put a link next to results on the
                 # web page
                 if 'link_name' in attachment:
-                    self.document['results'].setdefault('attach_links', []).append({
+                    results.setdefault('attach_links', []).append({
                         'id': attachment['filename'],
                         'name': attachment['link_name']
                     })
-            del self.document['results']['attachments']
-            self.database.save(self.document)
-            self.document = self.database[self.document.id]
-        
+
         self.document['results'] = results
         self.document['completed'] = time.time()
-        self.database.save(self.document)
+        self.document.update(self.cache_keys)
+
+        try:
+            self.save_results(attachments)
+        except couchdb.http.ResourceConflict:
+            # the document changed since it was read; write over the latest
+            print 'Task.finish: Caught couchdb.http.ResourceConflict, retrying'
+            document = self.database[self.document.id]
+            document['results'] = self.document['results']
+            document['completed'] = self.document['completed']
+            document.update(self.cache_keys)
+            self.document = document
+            self.save_results(attachments)
+
+    def save_results(self, attachments):
+        '''Save the finished task document, with any new attachments.
+
+        :param attachments: List of attachment dictionaries, or None
+        '''
+        if attachments:
+            self.save_with_attachments(attachments)
+        else:
+            self.database.save(self.document)
+
+    @classmethod
+    def get_input_key(cls, document, cache_dir=None):
+        '''Compute a key identifying everything a task's results depend on,
+        apart from the tools installed on the node.
+
+        Tasks share an input key if they have the same name and arguments
+        apart from the revision SHA, test identical trees (see
+        `git_tree_hashes`), and run the same task code.
+
+        :param document: Task document from the database
+        :param cache_dir: Git cache directory, by default $COG_GIT_CACHE
+        :returns: The key, or None if the results cannot be cached
+        '''
+        if not cls.cache_results:
+            return None
+
+        kwargs = dict(document.get('kwargs', {}))
+        sha = kwargs.pop('sha', None)
+        git_url = kwargs.get('git_url')
+        if sha is None or git_url is None:
+            return None
+
+        trees = git_tree_hashes(git_url, sha, kwargs.get('base_repo_url'),
+                                kwargs.get('base_repo_ref'), cache_dir)
+        if trees is None:
+            return None
+
+        code = hashlib.sha1()
+        for path in (inspect.getsourcefile(cls), inspect.getsourcefile(Task)):
+            with open(path) as f:
+                code.update(f.read())
+
+        key = [document.get('name'), kwargs, trees, code.hexdigest()]
+
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def get_result_key(self, input_key):
+        '''Compute the key under which the results of a task are cached.
+
+        This is the input key (see `get_input_key`) combined with the output
+        of the `tool_versions` commands on this node.
+
+        :param input_key: The task's input key, or None
+        :returns: The key, or None if the results cannot be cached
+        '''
+        if input_key is None:
+            return None
+
+        versions = []
+        for command in self.tool_versions:
+            try:
+                versions.append(system_output(command))
+            except subprocess.CalledProcessError:
+                return None
+
+        key = [input_key, versions]
+
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def finish_cached(self, source):
+        '''Complete the task with the results of an identical earlier task.
+
+        :param source: The earlier task document, with attachment stubs
+        '''
+        print 'Task.finish_cached: Reusing the results of %s' % source.id
+
+        try:
+            self.document = complete_from_cache(self.database, self.document,
+                                                source, self.cache_keys)
+        except couchdb.http.ResourceConflict:
+            print 'Task.finish_cached: %s was already completed' % \
+                self.document.id
+
+    def attachment_part(self, attachment):
+        '''Describe an attachment for a multipart document upload.
+
+        Attachments are dictionaries with a 'filename' and either 'contents',
+        a string, or 'path', a file which is streamed to the database rather
+        than read into memory. If 'gzip' is set, the data is compressed on
+        disk first and stored with gzip content encoding, which CouchDB
+        decodes for clients that do not accept it.
+
+        :param attachment: The attachment dictionary
+        :returns: Tuple of (attachment stub for the document, function
+                  returning a file object with the data)
+        '''
+        filename = attachment['filename']
+        content_type = ';'.join(filter(None, mimetypes.guess_type(filename)))
+
+        if 'path' in attachment:
+            path = attachment['path']
+            length = os.path.getsize(path)
+        else:
+            contents = attachment['contents'] or ''
+            if isinstance(contents, unicode):
+                contents = contents.encode('utf-8')
+            length = len(contents)
+
+        stub = {
+            'follows': True,
+            'content_type': content_type or 'application/octet-stream',
+            'length': length
+        }
+
+        if attachment.get('gzip'):
+            fd, gzip_path = tempfile.mkstemp(suffix='.gz', dir=self.work_dir)
+            os.close(fd)
+
+            with gzip.open(gzip_path, 'wb') as gz:
+                if 'path' in attachment:
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, gz)
+                else:
+                    gz.write(contents)
+
+            stub['encoding'] = 'gzip'
+            stub['encoded_length'] = os.path.getsize(gzip_path)
+            return stub, lambda: open(gzip_path, 'rb')
+
+        if 'path' in attachment:
+            return stub, lambda: open(path, 'rb')
+
+        return stub, lambda: StringIO.StringIO(contents)
+
+    def save_with_attachments(self, attachments):
+        '''Save the task document together with new attachments.
+
+        The document is sent as one multipart/related request, with the
+        attachment data streamed after the document JSON; see
+        `put_multipart`.
+
+        :param attachments: List of attachment dictionaries
+        '''
+        stubs = collections.OrderedDict(self.document.get('_attachments', {}))
+        openers = []
+        for attachment in attachments:
+            stub, opener = self.attachment_part(attachment)
+            stubs.pop(attachment['filename'], None)
+            stubs[attachment['filename']] = stub
+            openers.append(opener)
+
+        document = dict(self.document)
+        document['_attachments'] = stubs
+        put_multipart(self.database, document, openers)
+
+        self.document['_attachments'] = document['_attachments']
+        self.document['_rev'] = document['_rev']
 
     def run(self, document, work_dir):
         '''Override this method to define task code.
@@ -104,6 +351,250 @@ class Task(object):
         raise Exception('Task.run: Cannot call run method on base class')
 
 
+class MultipartBody(object):
+    '''A file-like request body made by concatenating several parts.
+
+    Parts are either strings or functions that open a file object; files are
+    opened only when reached and closed once read, so a body with many large
+    files needs neither the memory nor the file handles to hold them all.
+
+    :param parts: List of strings and file-opening functions
+    '''
+    def __init__(self, parts):
+        self.source = list(parts)
+        self.parts = list(parts)
+        self.current = None
+
+    def seek(self, offset):
+        '''Rewind the body to the start, so the request can be resent.
+
+        :param offset: Position to seek to; only 0 is supported
+        '''
+        if offset != 0:
+            raise ValueError('MultipartBody can only be rewound to the start')
+
+        if self.current is not None:
+            self.current.close()
+
+        self.parts = list(self.source)
+        self.current = None
+
+    def read(self, size=-1):
+        '''Read up to `size` bytes from the current part.
+
+        :param size: Maximum number of bytes to return
+        :returns: The next chunk, or an empty string at the end
+        '''
+        while True:
+            if self.current is None:
+                if not self.parts:
+                    return ''
+
+                part = self.parts.pop(0)
+                if isinstance(part, basestring):
+                    return part
+
+                self.current = part()
+
+            chunk = self.current.read(size)
+            if chunk:
+                return chunk
+
+            self.current.close()
+            self.current = None
+
+
+def put_multipart(database, document, openers):
+    '''Save a document together with attachment data, in one request.
+
+    The document is sent as a multipart/related request, with the data of
+    each new attachment streamed after the document JSON. The length of every
+    part is known, so the request is sent with a Content-Length rather than
+    chunked, which CouchDB 1.x cannot read; see
+    `cog.db.PooledSession.put_stream`.
+
+    On success, the stubs of the new attachments and the revision of the
+    document are updated to match the database.
+
+    :param database: couchdb.client.Database from `cog.db.CouchDB`
+    :param document: The document, whose '_attachments' hold a stub with
+                     'follows' set for each new attachment, in the order of
+                     `openers`
+    :param openers: Functions returning a file object with the data of each
+                    new attachment
+    :raises: The couchdb.http exception matching an error response
+    '''
+    boundary = uuid.uuid4().hex
+    stubs = document.get('_attachments', {})
+
+    # the parts must follow in the order the attachments are listed
+    delimiter = '\r\n--%s' % boundary
+    parts = ['--%s\r\nContent-Type: application/json\r\n\r\n%s' %
+             (boundary, json.dumps(document))]
+    for opener in openers:
+        parts.append(delimiter + '\r\n\r\n')
+        parts.append(opener)
+    parts.append(delimiter + '--')
+
+    length = sum(len(part) for part in parts if isinstance(part, basestring))
+    length += sum(stub.get('encoded_length', stub['length'])
+                  for stub in stubs.values() if stub.get('follows'))
+
+    headers = {
+        'Content-Type': 'multipart/related;boundary="%s"' % boundary
+    }
+    # the database comes from cog.db.CouchDB, so it has a PooledSession
+    resource = database.resource(document['_id'])
+    data = resource.session.put_stream(resource.url, MultipartBody(parts),
+                                       length, headers, resource.credentials)
+
+    # the uploaded attachments are now stubs of the new revision
+    for stub in stubs.values():
+        if stub.pop('follows', False):
+            stub['stub'] = True
+    document['_rev'] = data['rev']
+
+
+def find_cached_result(database, key, doc_id=None):
+    '''Look for a completed task with a given input or result key.
+
+    Uses the `pytunia/results_by_key` view, which only lists results that are
+    safe to reuse.
+
+    :param database: couchdb.client.Database holding the tasks
+    :param key: The input or result key, or None
+    :param doc_id: ID of the task looking, which is never returned
+    :returns: The earlier task document, with attachment stubs, or None
+    '''
+    if key is None:
+        return None
+
+    try:
+        rows = list(database.view('pytunia/results_by_key', key=key, limit=2))
+    except couchdb.http.ResourceNotFound:
+        print 'find_cached_result: No pytunia/results_by_key view'
+        return None
+
+    for row in rows:
+        if row.id != doc_id:
+            return database.get(row.id)
+
+    return None
+
+
+def complete_from_cache(database, document, source, cache_keys=None):
+    '''Complete a task with the results of an identical earlier task.
+
+    The results and attachments are copied in a single request, with the
+    attachment data streamed from the earlier task rather than held in
+    memory, and the results are marked with the ID of the task they came
+    from.
+
+    :param database: couchdb.client.Database holding the tasks
+    :param document: The task document to complete
+    :param source: The earlier task document, with attachment stubs
+    :param cache_keys: Dictionary of cache keys to store on the document
+    :returns: The saved task document
+    :raises couchdb.http.ResourceConflict if the task has been completed by
+            something else in the meantime
+    '''
+    results = copy.deepcopy(source['results'])
+    results['cached_from'] = source.id
+
+    # attachments are read without gzip encoding, so at their full length
+    stubs = collections.OrderedDict()
+    openers = []
+    for filename, attachment in source.get('_attachments', {}).items():
+        stubs[filename] = {
+            'follows': True,
+            'content_type': attachment['content_type'],
+            'length': attachment['length']
+        }
+        openers.append(functools.partial(open_attachment, database, source,
+                                         filename))
+
+    fields = dict(cache_keys or {})
+    fields['results'] = results
+    fields['completed'] = time.time()
+    fields['_attachments'] = stubs
+
+    document.update(fields)
+    try:
+        put_multipart(database, document, openers)
+    except couchdb.http.ResourceConflict:
+        document = database[document.id]
+        if 'completed' in document:
+            raise
+
+        print 'complete_from_cache: Caught couchdb.http.ResourceConflict, ' \
+            'retrying'
+        document.update(fields)
+        put_multipart(database, document, openers)
+
+    return document
+
+
+def open_attachment(database, document, filename):
+    '''Open an attachment of a document for streaming.
+
+    :param database: couchdb.client.Database holding the document
+    :param document: The document
+    :param filename: Name of the attachment
+    :returns: A file-like object with the attachment data
+    :raises couchdb.http.ResourceNotFound if there is no such attachment
+    '''
+    data = database.get_attachment(document, filename)
+    if data is None:
+        raise couchdb.http.ResourceNotFound(('not_found', filename))
+    return data
+
+
+def resolve_doc_id(doc_id):
+    '''Resolve the task document ID given on the command line.
+
+    An argument of the form "@path" names a manifest written by
+    `cog.cluster.SLURMCluster.submit_tasks`, with one document ID per line;
+    the line is selected by the SLURM job array index.
+
+    :param doc_id: A document ID or "@" and a manifest path
+    :returns: The document ID
+    '''
+    if not doc_id.startswith('@'):
+        return doc_id
+
+    index = int(os.environ['SLURM_ARRAY_TASK_ID'])
+
+    return read_manifest(doc_id[1:])[index]
+
+
+def read_manifest(path):
+    '''Read the document IDs from a job manifest.
+
+    :param path: Path to the manifest file
+    :returns: List of document IDs
+    '''
+    with open(path) as manifest:
+        return manifest.read().split()
+
+
+def cpu_count():
+    '''Get the number of CPUs this job may use.
+
+    Uses the SLURM allocation if running in a job, otherwise the CPUs this
+    process is allowed to run on.
+
+    :returns: Number of CPUs
+    '''
+    for var in ('SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE'):
+        if os.environ.get(var, '').isdigit():
+            return max(int(os.environ[var]), 1)
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return multiprocessing.cpu_count()
+
+
 def system(cmd, work_dir=None):
     '''Call a function in the shell.
 
@@ -136,13 +627,374 @@ def system_output(cmd, work_dir=None):
     return subprocess.check_output([cmd], stderr=subprocess.STDOUT, executable='/bin/bash', shell=True)
 
 
-def git_clone(url, sha, target=None, work_dir=None, log=False):
+class FileLock(object):
+    '''An exclusive lock on a file, for use in a `with` statement.
+
+    Uses flock, so it serializes processes on one node, which is what the
+    node-local caches need.
+
+    :param path: Path of the lock file, created if needed
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.path, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+
+def make_cache_dir(path):
+    '''Create a cache directory shared by the jobs on a node.
+
+    :param path: The directory
+    :returns: True if the directory exists
+    '''
+    try:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    except OSError:
+        # another job may have created it first
+        if not os.path.isdir(path):
+            print 'make_cache_dir: Cannot create cache directory %s' % path
+            return False
+
+    return True
+
+
+def git_mirror(url, cache_dir=None, max_age=None):
+    '''Get an up-to-date bare mirror of a repository from the node cache.
+
+    The mirror is created with "git clone --mirror" the first time a URL is
+    seen on a node, and fetched again when it is older than `max_age`. Jobs
+    on the same node take turns through a lock file. Objects are never
+    removed from a mirror (automatic gc is disabled), so clones can reference
+    it while another job is fetching.
+
+    :param url: The URL of the repository
+    :param cache_dir: Cache directory, by default $COG_GIT_CACHE
+    :param max_age: Seconds before the mirror is refetched
+    :returns: Path to the mirror, or None if caching is disabled or failed
+    '''
+    cache_dir = cache_dir or GIT_CACHE_DIR
+    if max_age is None:
+        max_age = GIT_CACHE_MAX_AGE
+
+    if not cache_dir or not make_cache_dir(cache_dir):
+        return None
+
+    mirror = os.path.join(cache_dir, hashlib.sha1(url).hexdigest() + '.git')
+    stamp = mirror + '.fetched'
+
+    with FileLock(mirror + '.lock'):
+        if not os.path.exists(stamp):
+            if os.path.exists(mirror):
+                shutil.rmtree(mirror)  # left over from an interrupted clone
+            rc = system('git clone --mirror %s %s && '
+                        'git --git-dir=%s config gc.auto 0' %
+                        (url, mirror, mirror))
+        elif time.time() - os.path.getmtime(stamp) > max_age:
+            rc = system('git --git-dir=%s fetch --prune origin' % mirror)
+        else:
+            return mirror
+
+        if rc != 0:
+            print 'git_mirror: Failed to update mirror of %s' % url
+            return mirror if os.path.exists(stamp) else None
+
+        with open(stamp, 'w') as f:
+            f.write(url + '\n')
+
+    return mirror
+
+
+def existing_mirror(url, cache_dir=None):
+    '''Get the node's mirror of a repository only if it already exists.
+
+    Unlike `git_mirror`, never clones or fetches, for callers that only
+    want a part of the repository.
+
+    :param url: The URL of the repository
+    :param cache_dir: Cache directory, by default $COG_GIT_CACHE
+    :returns: Path to the mirror, or None if there is none
+    '''
+    cache_dir = cache_dir or GIT_CACHE_DIR
+    if not cache_dir:
+        return None
+
+    mirror = os.path.join(cache_dir, hashlib.sha1(url).hexdigest() + '.git')
+    if not os.path.exists(mirror + '.fetched'):
+        return None
+
+    return mirror
+
+
+def clone_command(url, target):
+    '''Build the shell command that clones a repository.
+
+    If a node-local mirror is available (see `git_mirror`), objects are
+    copied from it and only what is missing is fetched from `url`.
+
+    :param url: The URL to git clone
+    :param target: Directory to clone into
+    :returns: The command string
+    '''
+    mirror = git_mirror(url)
+    if mirror is None:
+        return ' '.join(['git clone', url, target])
+
+    return ' '.join(['git clone --reference', mirror, '--dissociate', url,
+                     target])
+
+
+def mirror_commit(url, ref, cache_dir=None, fetch_url=None):
+    '''Find a commit in the node's mirror of a repository.
+
+    If the commit is missing, the mirror is fetched once more, since it may
+    have been pushed after the last fetch. Given a `fetch_url`, e.g. that of
+    a fork, `ref` is fetched from there into the mirror instead (see
+    `mirror_fetch_commit`), so forks share the mirror of the repository they
+    were forked from.
+
+    :param url: The URL of the repository
+    :param ref: A branch name or SHA
+    :param cache_dir: Cache directory, by default $COG_GIT_CACHE
+    :param fetch_url: URL to fetch a missing `ref` from, if not `url`
+    :returns: Tuple of (path to the mirror, commit SHA), or (None, None)
+    '''
+    if fetch_url is not None:
+        return mirror_fetch_commit(url, fetch_url, ref, cache_dir)
+
+    for max_age in (None, 0):
+        mirror = git_mirror(url, cache_dir, max_age)
+        if mirror is None:
+            return None, None
+
+        try:
+            sha = system_output('git --git-dir=%s rev-parse --verify -q '
+                                '"%s^{commit}"' % (mirror, ref))
+            return mirror, sha.strip()
+        except subprocess.CalledProcessError:
+            continue
+
+    return None, None
+
+
+def mirror_fetch_commit(url, fetch_url, ref, cache_dir=None):
+    '''Fetch a commit of another repository into the node's mirror of a
+    repository; see `mirror_commit`.
+
+    Branch names are always looked up in `fetch_url`, since the mirror's
+    branch of the same name is a different one. Objects are never pruned
+    from the mirror, so the fetched commit needs no ref.
+
+    :param url: The URL of the mirrored repository
+    :param fetch_url: The URL to fetch `ref` from
+    :param ref: A branch name or SHA
+    :param cache_dir: Cache directory, by default $COG_GIT_CACHE
+    :returns: Tuple of (path to the mirror, commit SHA), or (None, None)
+    '''
+    mirror = git_mirror(url, cache_dir)
+    if mirror is None:
+        return None, None
+
+    if re.match(r'^[0-9a-f]{40}$', ref):
+        try:
+            sha = system_output('git --git-dir=%s rev-parse --verify -q '
+                                '"%s^{commit}"' % (mirror, ref))
+            return mirror, sha.strip()
+        except subprocess.CalledProcessError:
+            pass
+
+    # FETCH_HEAD is shared, so hold the lock until it is read
+    with FileLock(mirror + '.lock'):
+        try:
+            system_output('git --git-dir=%s fetch -q --no-tags %s %s' %
+                          (mirror, fetch_url, ref))
+            sha = system_output('git --git-dir=%s rev-parse --verify -q '
+                                '"FETCH_HEAD^{commit}"' % mirror)
+            return mirror, sha.strip()
+        except subprocess.CalledProcessError:
+            print 'mirror_fetch_commit: Cannot fetch %s from %s' % \
+                (ref, fetch_url)
+            return None, None
+
+
+def git_tree_hashes(git_url, sha, base_repo_url=None, base_repo_ref=None,
+                    cache_dir=None):
+    '''Find the trees a revision is tested on, without checking it out.
+
+    Commits are looked up in the node's git mirrors (see `git_mirror`), so
+    this only works with the git cache enabled. A fork revision is fetched
+    into the base repository's mirror. The pull request merge is
+    done with "git merge-tree --write-tree" (git 2.38 or later) in a scratch
+    repository that borrows the mirrors' objects.
+
+    :param git_url: The URL of the repository to test
+    :param sha: The revision to test
+    :param base_repo_url: The URL of the repository to merge into, if any
+    :param base_repo_ref: The branch to merge into, if any
+    :param cache_dir: Cache directory, by default $COG_GIT_CACHE
+    :returns: Dictionary with the 'tree' of `sha` and, given a base, the
+              'base_tree' and 'merged_tree'; or None if they cannot be found,
+              e.g. because the merge conflicts
+    '''
+    if base_repo_url is None or base_repo_ref is None:
+        mirror, commit = mirror_commit(git_url, sha, cache_dir)
+    else:
+        mirror, commit = mirror_commit(base_repo_url, sha, cache_dir,
+                                       fetch_url=git_url)
+    if mirror is None:
+        return None
+
+    trees = {
+        'tree': system_output('git --git-dir=%s rev-parse "%s^{tree}"' %
+                              (mirror, commit)).strip()
+    }
+
+    if base_repo_url is None or base_repo_ref is None:
+        return trees
+
+    base_mirror, base_commit = mirror_commit(base_repo_url, base_repo_ref,
+                                             cache_dir)
+    if base_mirror is None:
+        return None
+
+    trees['base_tree'] = system_output('git --git-dir=%s rev-parse "%s^{tree}"'
+                                       % (base_mirror, base_commit)).strip()
+
+    scratch = tempfile.mkdtemp()
+    try:
+        system_output('git init -q --bare %s' % scratch)
+        with open(os.path.join(scratch, 'objects', 'info', 'alternates'),
+                  'w') as f:
+            for path in (mirror, base_mirror):
+                f.write(os.path.join(path, 'objects') + '\n')
+
+        merged = system_output('git --git-dir=%s merge-tree --write-tree '
+                               '%s %s' % (scratch, base_commit, commit))
+        trees['merged_tree'] = merged.split()[0]
+    except subprocess.CalledProcessError as e:
+        print 'git_tree_hashes: Cannot merge %s into %s: %s' % \
+            (sha, base_repo_ref, e.output)
+        return None
+    finally:
+        shutil.rmtree(scratch)
+
+    return trees
+
+
+def fetch_command(remote, ref, strategy):
+    '''Build the shell command that fetches a single ref for a strategy.
+
+    :param remote: Name of the remote to fetch from
+    :param ref: The branch name or SHA to fetch
+    :param strategy: Clone strategy (see `strategy_clone`)
+    :returns: The command string
+    '''
+    options = []
+    if strategy.get('depth'):
+        options.append('--depth=%i' % strategy['depth'])
+    if strategy.get('filter'):
+        options.append('--filter=%s' % strategy['filter'])
+
+    return ' '.join(['git fetch'] + options + [remote, ref])
+
+
+def strategy_clone(url, ref, target, strategy, logfile):
+    '''Fetch one revision of a repository into a new directory.
+
+    Used in place of a full "git clone" by tasks that only need part of the
+    repository. The strategy is a dictionary with any of the keys:
+
+    * depth: Number of commits of history to fetch (shallow clone)
+    * filter: Object filter for a partial clone, e.g. "blob:none"
+    * paths: List of paths to check out (sparse checkout)
+
+    The revision is fetched from `url` as remote "origin" and checked out
+    (detached). A node-local mirror (see `git_mirror`) is used as an
+    alternate object store if one already exists; none is created, since
+    that would fetch the full history this is meant to avoid.
+
+    :param url: The URL of the repository
+    :param ref: The branch name or SHA to check out
+    :param target: Directory to clone into
+    :param strategy: The clone strategy
+    :param logfile: File to append console output to
+    :returns: Return code of the command chain
+    '''
+    os.makedirs(target)
+
+    cmds = ['git init -q', 'git remote add origin %s' % url]
+
+    mirror = existing_mirror(url)
+    if mirror is not None:
+        cmds.append('echo %s >> .git/objects/info/alternates' %
+                    os.path.join(mirror, 'objects'))
+
+    if strategy.get('paths'):
+        cmds.append('git config core.sparseCheckout true')
+        cmds.append("printf '%%s\\n' %s > .git/info/sparse-checkout" %
+                    ' '.join(strategy['paths']))
+
+    cmds.append(fetch_command('origin', ref, strategy))
+    cmds.append('git checkout -q FETCH_HEAD')
+
+    return system('(%s) >> %s 2>&1' % (' && '.join(cmds), logfile), target)
+
+
+def deepen_to_merge_base(ref, sha, repo_dir, depth=50, max_steps=6):
+    '''Deepen a shallow clone until HEAD and a fork revision share history.
+
+    Both the base ref (remote "origin") and the fork revision (remote "fork")
+    are deepened, doubling the depth each step, and as a last resort the
+    full history is fetched.
+
+    :param ref: The base branch name or SHA
+    :param sha: The fork revision to be merged
+    :param repo_dir: The repository directory
+    :param depth: Initial number of commits to deepen by
+    :param max_steps: Number of attempts before fetching full history
+    :returns: Return code of "git merge-base"
+    '''
+    if not os.path.exists(os.path.join(repo_dir, '.git', 'shallow')):
+        return 0
+
+    merge_base = 'git merge-base HEAD %s > /dev/null' % sha
+
+    for _ in range(max_steps):
+        if system(merge_base, repo_dir) == 0:
+            return 0
+
+        system('git fetch -q --deepen=%i origin %s && '
+               'git fetch -q --deepen=%i fork %s' % (depth, ref, depth, sha),
+               repo_dir)
+        depth *= 2
+
+    system('git fetch -q --depth=2147483647 origin %s && '
+           'git fetch -q --depth=2147483647 fork %s' % (ref, sha), repo_dir)
+
+    return system(merge_base, repo_dir)
+
+
+def git_clone(url, sha, target=None, work_dir=None, log=False,
+              strategy=None):
     '''Clone a git repository.
 
     The arguments are parsed as::
 
         cd [work_dir] && git clone [url] [target] && git checkout [sha]
 
+    If $COG_GIT_CACHE is set, the clone references a node-local mirror. If
+    a `strategy` is given, only the requested part of the repository is
+    fetched; see `strategy_clone`.
+
     You may need to set up SSH keys if authentication is needed.
 
     :param url: The URL to git clone
@@ -150,6 +1002,7 @@ def git_clone(url, sha, target=None, work_dir=None, log=False):
     :param target: Name of directory to clone into
     :param work_dir: Working directory in which to perform clone
     :param include_log: Return console output also
+    :param strategy: Optional clone strategy dictionary
     :returns: Return code of "git clone", optionally console output
     '''
     if target is None:
@@ -160,10 +1013,17 @@ def git_clone(url, sha, target=None, work_dir=None, log=False):
 
     target = os.path.abspath(target)
 
+    # If the target does not exist and only part of it is needed, fetch that.
+    if not os.path.exists(target) and strategy:
+        rc = strategy_clone(url, sha, target, strategy,
+                            os.path.join(target, 'clone.log'))
+
     # If the target does not exist, clone it.
-    if not os.path.exists(target):
-        cmd = ' '.join(['git clone', url, target, '&& cd %s && ' % target,
-                       'git checkout', sha, '&> clone.log'])
+    elif not os.path.exists(target):
+        cmd = ' '.join([clone_command(url, target),
+                        '&& cd %s && ' % target,
+                        'git checkout', sha, '&> clone.log'])
+        rc = system(cmd)
 
     # If the target does exist, change into it and attempt to checkout the sha.
     else:
@@ -174,8 +1034,7 @@ def git_clone(url, sha, target=None, work_dir=None, log=False):
 
         cmd = ' '.join(['cd %s && ' % target,
                         'git checkout', sha, '&> clone.log'])
-
-    rc = system(cmd)
+        rc = system(cmd)
 
     if log:
         with open(os.path.join(target, 'clone.log')) as f:
@@ -187,7 +1046,7 @@ def git_clone(url, sha, target=None, work_dir=None, log=False):
 
 
 def simulate_pr(base_url, base_ref, fork_url, sha, target=None, work_dir=None,
-                log=False):
+                log=False, strategy=None):
     '''Simulate the merge button on GitHub.
 
     The arguments are parsed as::
@@ -199,6 +1058,11 @@ def simulate_pr(base_url, base_ref, fork_url, sha, target=None, work_dir=None,
         git fetch fork
         git merge --no-edit --no-ff [sha]
 
+    If $COG_GIT_CACHE is set, the clone references a node-local mirror. If
+    a `strategy` is given, only the requested part of the base repository
+    and the fork revision is fetched (see `strategy_clone`), and shallow
+    history is deepened just enough to find the merge base.
+
     You may need to set up SSH keys if authentication is needed.
 
     :param base_url: The URL to git clone
@@ -208,6 +1072,7 @@ def simulate_pr(base_url, base_ref, fork_url, sha, target=None, work_dir=None,
     :param target: Name of directory to clone into
     :param work_dir: Working directory in which to perform clone
     :param include_log: Return console output also
+    :param strategy: Optional clone strategy dictionary
     :returns: Last return code, optionally console output
     '''
     if target is None:
@@ -220,14 +1085,28 @@ def simulate_pr(base_url, base_ref, fork_url, sha, target=None, work_dir=None,
     logfile = os.path.join(work_dir, 'clone.log')
 
     if not os.path.exists(target):
-        cmd = ' '.join(['git clone', base_url, target, '&&',
-                        'cd', target, '&&',
-                        'git checkout', base_ref, '&&',
-                        'git remote add fork', fork_url, '&&',
-                        'git fetch fork', '&&',
-                        'git merge --no-edit --no-ff', sha, '&&',
-                        '>>', logfile, '2>&1'])
-        rc = system(cmd)
+        if strategy:
+            rc = strategy_clone(base_url, base_ref, target, strategy, logfile)
+            if rc == 0:
+                cmd = ' '.join(['git remote add fork', fork_url, '&&',
+                                fetch_command('fork', sha, strategy),
+                                '>>', logfile, '2>&1'])
+                rc = system(cmd, target)
+            if rc == 0:
+                rc = deepen_to_merge_base(base_ref, sha, target)
+            if rc == 0:
+                cmd = ' '.join(['git merge --no-edit --no-ff', sha,
+                                '>>', logfile, '2>&1'])
+                rc = system(cmd, target)
+        else:
+            cmd = ' '.join([clone_command(base_url, target), '&&',
+                            'cd', target, '&&',
+                            'git checkout', base_ref, '&&',
+                            'git remote add fork', fork_url, '&&',
+                            'git fetch fork', '&&',
+                            'git merge --no-edit --no-ff', sha, '&&',
+                            '>>', logfile, '2>&1'])
+            rc = system(cmd)
 
         if log:
             try:
@@ -278,16 +1157,34 @@ def git_merge(url, ref, work_dir=None):
 
     return system(cmd, work_dir)
 
-def get_changed_files(sha,repo_dir):
+def get_changed_files(sha,repo_dir,base=''):
     '''Get a list of files changed in the fetched code using git diff. (remote must be fetched)
     "..." gives only changes new in sha relative to local
     :param sha: sha of fork to test
+    :param base: ref to compare against, by default the checked out HEAD;
+                 after `simulate_pr`, compare "HEAD" against the base commit
+                 (see `get_base_sha`)
     :returns: list of file paths relative to rat dir
     '''
-    cmd = "git diff --name-only ...%s" %(sha)
+    cmd = "git diff --name-only %s...%s" %(base, sha)
     changed_files = system_output(cmd,repo_dir).splitlines()
     return changed_files
     
+def get_base_sha(repo_dir):
+    '''Find the base branch commit `simulate_pr` merged onto.
+
+    When the fork revision is already in the base branch, no merge commit
+    is made and HEAD is the base branch itself.
+
+    :param repo_dir: Path to the merged checkout
+    :returns: SHA of the base branch commit
+    '''
+    if system('git rev-parse -q --verify "HEAD^2" > /dev/null', repo_dir) == 0:
+        ref = 'HEAD^1'
+    else:
+        ref = 'HEAD'
+    return system_output('git rev-parse "%s"' % ref, repo_dir).strip()
+
 def get_diff(file,sha,repo_dir):
     ''' Get the diff for a file for a given sha. (remote must be fetched) 
     "..." gives only changes new in sha relative to local
@@ -307,24 +1204,177 @@ def get_diff(file,sha,repo_dir):
         cmd = "git diff -U0 ...%s %s" %(sha,file)
         return system_output(cmd,repo_dir)
     
+def load_analysis(name):
+    '''Read an entry from the analysis cache.
+
+    :param name: The entry name, which should include a content hash
+    :returns: The cached JSON data, or None if missing or caching is disabled
+    '''
+    if not ANALYSIS_CACHE_DIR:
+        return None
+
+    try:
+        with open(os.path.join(ANALYSIS_CACHE_DIR, name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_analysis(name, data):
+    '''Write an entry to the analysis cache.
+
+    The entry is written to a temporary file and renamed into place, so
+    readers never see a partial entry.
+
+    :param name: The entry name, which should include a content hash
+    :param data: JSON-serializable data to store
+    '''
+    if not ANALYSIS_CACHE_DIR or not make_cache_dir(ANALYSIS_CACHE_DIR):
+        return
+
+    fd, path = tempfile.mkstemp(dir=ANALYSIS_CACHE_DIR, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(path, os.path.join(ANALYSIS_CACHE_DIR, name))
+
+
+def build_cache_key(work_dir, options, configure_options):
+    '''Compute the build cache key for a checkout.
+
+    The key covers the source tree (not the commit, so identical merges
+    share a build), the configure and scons options apart from parallelism,
+    and the build environment.
+
+    :param work_dir: The checkout directory
+    :param options: Options to pass to scons
+    :param configure_options: Options to pass to configure
+    :returns: Hex digest, or None if the tree hash cannot be determined
+    '''
+    try:
+        tree = system_output('git rev-parse HEAD^{tree}', work_dir).strip()
+    except subprocess.CalledProcessError:
+        return None
+
+    key = hashlib.sha1(tree)
+    key.update(repr(sorted(configure_options)))
+    key.update(repr(sorted(o for o in options if not o.startswith('-j'))))
+    key.update(os.uname()[4])
+    for var in BUILD_ENV_VARS:
+        key.update('%s=%s\n' % (var, os.environ.get(var, '')))
+
+    return key.hexdigest()
+
+
+def publish_build(work_dir, entry, log_text):
+    '''Copy a successful build into the build cache.
+
+    The tree is stored under "tree" in the entry, next to the return code
+    and log. The entry is renamed into place once complete and never changes
+    after that.
+
+    :param work_dir: The checkout directory
+    :param entry: Cache directory for this build
+    :param log_text: Text of the build log
+    '''
+    staging = tempfile.mkdtemp(dir=os.path.dirname(entry))
+
+    tree = os.path.join(staging, 'tree')
+    os.mkdir(tree)
+    excludes = ' '.join('--exclude=./%s' % f for f in BUILD_CACHE_EXCLUDE)
+    rc = system('tar -cf - %s . | tar -xf - -C %s' % (excludes, tree),
+                work_dir)
+    if rc != 0:
+        print 'publish_build: Failed to copy build to cache'
+        shutil.rmtree(staging, ignore_errors=True)
+        return
+
+    with open(os.path.join(staging, 'scons_returncode'), 'w') as f:
+        f.write('0\n')
+    with open(os.path.join(staging, 'build_log.txt'), 'w') as f:
+        f.write(log_text)
+
+    os.rename(staging, entry)
+
+
 def scons_build(work_dir, options=None, configure=True,
-        configure_options=None):
-    '''Compile with scons.
+        configure_options=None, cache_dir=None):
+    '''Compile with scons, reusing a cached build of the same tree.
+
+    If a build cache is configured ($COG_BUILD_CACHE), the first task on a
+    node to build a given tree (see `build_cache_key`) publishes the result,
+    and later tasks copy it into their checkout, so that the scons run only
+    has to confirm that everything is up to date. Jobs building the same
+    tree at the same time wait for the first one to finish. Only successful
+    builds are cached, so a failure, which may be transient (e.g. running
+    out of memory or disk), is retried by the next task.
 
     Note: Returns (None, None) if configure runs and fails.
 
     :param work_dir: Working directory
-    :param options: Options to pass to scons
+    :param options: Options to pass to scons; unless a -j option is given,
+                    one job is run per CPU allocated (see `cpu_count`)
     :param configure: If True, run "./configure" first
     :param configure_options: Options to pass to configure
+    :param cache_dir: Build cache directory, by default $COG_BUILD_CACHE
     :returns: Tuple with (return code of "scons", text of log)
     '''
     if options is None:
-        options = ['-j2']
+        options = []
+
+    if not [o for o in options if o.startswith('-j')]:
+        options = options + ['-j%i' % cpu_count()]
 
     if configure_options is None:
         configure_options = []
 
+    cache_dir = cache_dir or BUILD_CACHE_DIR
+
+    key = None
+    if cache_dir and make_cache_dir(cache_dir):
+        key = build_cache_key(work_dir, options, configure_options)
+
+    if key is None:
+        return scons_compile(work_dir, options, configure, configure_options)
+
+    entry = os.path.join(cache_dir, key)
+
+    with FileLock(entry + '.lock'):
+        # entries of failed builds, cached by older versions, have no tree
+        if (os.path.exists(entry) and
+                not os.path.isdir(os.path.join(entry, 'tree'))):
+            print 'scons_build: Removing incomplete cached build %s' % entry
+            shutil.rmtree(entry, ignore_errors=True)
+
+        if not os.path.exists(entry):
+            ret, log_text = scons_compile(work_dir, options, configure,
+                                          configure_options)
+
+            if ret == 0:
+                publish_build(work_dir, entry, log_text)
+
+            return ret, log_text
+
+    # entries are complete once they exist and never change, so the copy
+    # does not need the lock
+    print 'scons_build: Using cached build %s' % entry
+    if system('cp -a %s/. .' % os.path.join(entry, 'tree'), work_dir) != 0:
+        # scons rebuilds whatever was not copied
+        print 'scons_build: Failed to copy cached build %s' % entry
+
+    return scons_compile(work_dir, options, configure, configure_options)
+
+
+def scons_compile(work_dir, options, configure, configure_options):
+    '''Run configure and scons in a checkout.
+
+    Note: Returns (None, None) if configure runs and fails.
+
+    :param work_dir: Working directory
+    :param options: List of options to pass to scons
+    :param configure: If True, run "./configure" first
+    :param configure_options: List of options to pass to configure
+    :returns: Tuple with (return code of "scons", text of log)
+    '''
     if configure:
         system('./configure %s' % ' '.join(configure_options), work_dir)
 
@@ -342,4 +1392,3 @@ def scons_build(work_dir, options=None, configure=True,
         log_text = log_file.read()
 
     return ret, log_text
-
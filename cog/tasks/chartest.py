@@ -1,5 +1,7 @@
 '''A  task to look for bad and non-ASCII chars, missing EOF newlines, tabs and trailing whitespace'''
 import os
+import re
+import bisect
 import cog.task
 
 # Only allow ASCII characters, and a specific subset of that.
@@ -8,6 +10,13 @@ CHAR_MIN = 0x20
 CHAR_MAX = 0x7e
 ALLOWED_CHARS = (0x0a,)
 
+# Anything char_check reports: bytes outside the allowed range (which covers
+# tabs, CRs and non-ASCII), and spaces at the end of a line.
+PROBLEM_RE = re.compile(r'[^\x20-\x7e\n]| (?=\n|\Z)')
+
+# Hunk headers, of the form @@ -18,4 +19,5 @@ or @@ -18,0 +55 @@
+HUNK_RE = re.compile(r'^@@.*$', re.MULTILINE)
+
 # Only look at files with extensions (or names, in the case of no extension):
 CODE_EXTS = [".py", ".scons", ".config",
              ".cc", ".c", ".C", ".cpp", ".hh", ".h", ".hpp", ".tpp",
@@ -20,6 +29,10 @@ class CharCheck(cog.task.Task):
     '''Check a revision for tab chars, bad ASCII, missing EOF newlines and EOL whitespace
     Clone the master repository, fetch the PR and examine the diff.
     '''
+    # the diff needs history to find the merge base, but only the blobs of
+    # the changed files
+    clone_strategy = {'filter': 'blob:none'}
+    cache_results = True
 
     def __init__(self,*args):
         cog.task.Task.__init__(self,*args)
@@ -47,7 +60,8 @@ class CharCheck(cog.task.Task):
                     'reason': 'incomplete base specification for merge'}
 
         #Clone Master Code
-        code = cog.task.git_clone(base_repo_url, base_repo_ref, base_repo_ref, work_dir=work_dir)
+        code = cog.task.git_clone(base_repo_url, base_repo_ref, base_repo_ref, work_dir=work_dir,
+                                  strategy=self.clone_strategy)
         if code is None or (code != 0 and code != 1):
             return {'success': False, 'reason': 'git clone failed',
                     'code': str(code)}
@@ -133,6 +147,10 @@ class CharCheck(cog.task.Task):
         Read the diff for a file,
         find tab chars, bad and non-ASCII chars,
         trailing whitespace, and missing EOF newlines
+
+        The whole diff is searched at once for anything to report, and only
+        the added lines with a match are checked in detail.
+
         :param diff: the diff string
         :returns: a list of errors for the file
         '''
@@ -142,87 +160,122 @@ class CharCheck(cog.task.Task):
         if "\ No newline at end of file" in diff:
             errors.append("No EOF newline")
 
-        line_number = -999
+        # The new file line number of the first line of each hunk, and where
+        # each hunk header ends.
+        hunks = [(match.end(), self.hunk_start(match.group(0)))
+                 for match in HUNK_RE.finditer(diff)]
+        hunk_ends = [hunk_end for hunk_end, start in hunks]
+
+        line_end = -1
+        for match in PROBLEM_RE.finditer(diff):
+            # Only check each line once.
+            if match.start() <= line_end:
+                continue
+
+            # Grab the line with and without the ending linebreak included.
+            line_start = diff.rfind('\n', 0, match.start()) + 1
+            line_end = diff.find('\n', match.start())
+            if line_end < 0:
+                line_end = len(diff)
+            line_lb = diff[line_start:line_end + 1]
+            line = diff[line_start:line_end]
+            if line.endswith('\r'):
+                line = line[:-1]
 
-        # Grab the line with and without the ending linebreaks included.
-        # Use line /without/ linebreaks to check for blank lines and whitespace.
+            # Skip the file header, and removed or hunk header lines.
+            hunk = bisect.bisect_right(hunk_ends, line_start) - 1
+            if hunk < 0 or line[:1] != "+":
+                continue
+
+            # Count the added lines from the start of the hunk.
+            hunk_end, line_number = hunks[hunk]
+            line_number += diff.count('\n+', hunk_end, line_start)
+
+            errors += self.check_line(line[1:], line_lb, line_number)
+
+        return errors
+
+    @staticmethod
+    def hunk_start(header):
+        '''
+        Get the new file line number a hunk starts at.
+
+        :param header: the hunk header line
+        :returns: the line number, or -999 if the header has none
+        '''
+        try:
+            line_context = header.split("+")[1].split("@@")[0]
+            if "," in line_context:
+                line_number = line_context.split(",")[0]
+            else:
+                line_number = line_context
+            return int(line_number)
+        except:
+            print("warning: failed to interpret hunk header {}: "
+                  "line #s not provided".format(header))
+            return -999
+
+    @staticmethod
+    def check_line(line, line_lb, line_number):
+        '''
+        Find tab chars, bad and non-ASCII chars and trailing whitespace in
+        one added line.
+
+        :param line: the line, without the '+' and linebreak
+        :param line_lb: the line as in the diff, with the linebreak
+        :param line_number: the line number in the new file
+        :returns: a list of errors for the line
+        '''
+        errors = []
+
+        # Use line /without/ linebreaks to check for whitespace.
         # Use line /with/ linebreaks to check for bad characters
         # (including invisible ones).
-        for line, line_lb in zip(diff.splitlines(False), diff.splitlines(True)):
-            # grab the hunk and count lines from here. The form is @@ -18,4 +19,5 @@
-            # or @@ -18,0 +55 @@
-            if line[:2] == "@@":
-                try:
-                    line_context = line.split("+")[1].split("@@")[0]
-                    if "," in line_context:
-                        line_number = line_context.split(",")[0]
-                    else:
-                        line_number = line_context
-                    line_number = int(line_number)
-                except:
-                    print("warning: failed to interpret hunk header {}: "
-                          "line #s not provided".format(line))
-                    line_number = -999
-
-            # Look for new lines or other lines to skip.
-            if len(line) == 0 or line[0] != "+" or line[:3] == "+++":
-                continue
+        # Check for trailing whitespace.
+        trailing_white_space = len(line) - len(line.rstrip())
+        if trailing_white_space:
+            errors.append("{} trailing whitespace {} on line {}: "
+                          "'{}'".format(trailing_white_space,
+                                        "chars" if trailing_white_space > 1 else "char",
+                                        line_number,
+                                        line[0:100]))
+
+        # Try to decode the byte string using UTF-8.
+        # If it can't be done, just work with the byte string
+        # and issue error about a different file encoding.
+        try:
+            line_unicode = line_lb.decode('utf-8')
+        except UnicodeDecodeError:
+            line_unicode = line_lb
+            errors.append("Could not decode line {} using UTF-8. "
+                          "Please check the file encoding.".format(line_number))
+
+        # Check the line for disallowed characters and keep track of the counts.
+        bad_chars = {}
+        for c in line_unicode:
+            co = ord(c)
+            if (co < CHAR_MIN or co > CHAR_MAX) and (co not in ALLOWED_CHARS):
+                if c not in bad_chars:
+                    bad_chars[c] = 1
+                else:
+                    bad_chars[c] += 1
+
+        for c, count in bad_chars.items():
+            # Generate an error message of the number of counts of bad characters.
+            # Only print up to the first 100 characters of the line.
+            error = ("{} {} of char {} on line {}: "
+                     "'{}'".format(count,
+                                   "copy" if count == 1 else "copies",
+                                   hex(ord(c)),
+                                   line_number,
+                                   line[0:100]))
+
+            if ord(c) == 0x09:
+                error += " <b>=> new TABs</b>"
+            elif ord(c) == 0x0d:
+                error += " <b>=> carriage return (Windows-style line ending?)</b>"
 
-            # Remove first instance of '+' character from line.
-            line = line[1:]
-
-            # Check for trailing whitespace.
-            trailing_white_space = len(line) - len(line.rstrip())
-            if trailing_white_space:
-                errors.append("{} trailing whitespace {} on line {}: "
-                              "'{}'".format(trailing_white_space,
-                                            "chars" if trailing_white_space > 1 else "char",
-                                            line_number,
-                                            line[0:100]))
-
-            # Try to decode the byte string using UTF-8.
-            # If it can't be done, just work with the byte string
-            # and issue error about a different file encoding.
-            try:
-                line_unicode = line_lb.decode('utf-8')
-            except UnicodeDecodeError:
-                line_unicode = line_lb
-                errors.append("Could not decode line {} using UTF-8. "
-                              "Please check the file encoding.".format(line_number))
-
-            # Check the minimum and maximum ordinal range of the entire line.
-            # More efficient than a standard for loop over characters in the line,
-            # assuming that most lines don't contain non-ASCII characters.
-            # Only loop through characters if check is failed.
-            if ord(min(line_unicode)) < CHAR_MIN or ord(max(line_unicode)) > CHAR_MAX:
-                # Check the line for disallowed characters and keep track of the counts.
-                bad_chars = {}
-                for c in line_unicode:
-                    co = ord(c)
-                    if (co < CHAR_MIN or co > CHAR_MAX) and (co not in ALLOWED_CHARS):
-                        if c not in bad_chars:
-                            bad_chars[c] = 1
-                        else:
-                            bad_chars[c] += 1
-
-                for c, count in bad_chars.items():
-                    # Generate an error message of the number of counts of bad characters.
-                    # Only print up to the first 100 characters of the line.
-                    error = ("{} {} of char {} on line {}: "
-                             "'{}'".format(count,
-                                           "copy" if count == 1 else "copies",
-                                           hex(ord(c)),
-                                           line_number,
-                                           line[0:100]))
-
-                    if ord(c) == 0x09:
-                        error += " <b>=> new TABs</b>"
-                    elif ord(c) == 0x0d:
-                        error += " <b>=> carriage return (Windows-style line ending?)</b>"
-
-                    errors.append(error)
-
-            line_number += 1
+            errors.append(error)
 
         return errors
 
@@ -1,6 +1,11 @@
 '''A task that runs cppcheck on a revision.'''
 
 import os
+import re
+import json
+import shutil
+import hashlib
+import collections
 from xml.etree.ElementTree import ElementTree
 import cog.task
 
@@ -9,6 +14,11 @@ class CPPCheck(cog.task.Task):
 
     Check out a branch of a git repository, optionally merge in another ref,
     and run cppcheck on the results.
+
+    When testing a merge, only the files the merge changes are checked, along
+    with the files that include changed headers, and only issues not already
+    present in the base branch count; see `check_changes`. Checks of a plain
+    branch, or with the "full_scan" argument, scan the whole source tree.
     '''
     # non-'error' IDs considered really bad in cppcheck.
     # errors are always critical.
@@ -17,6 +27,20 @@ class CPPCheck(cog.task.Task):
     # cppcheck IDs highlighted in the output, but not considered failure-worthy
     warn_ids = ['stlSize', 'passedByValue', 'invalidscanf', 'unusedVariable']
 
+    # In a future iteration of this code one might make the
+    # ignore folder part a bit more generic
+    # For now just ignore the libpq subdir
+    ignore_dirs = ['src/libpq', 'src/pygresql']
+
+    # files cppcheck analyzes
+    source_exts = ('.cc', '.cpp', '.cxx', '.c', '.hh', '.hpp', '.h')
+    header_exts = ('.hh', '.hpp', '.h')
+
+    include_re = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]')
+
+    cache_results = True
+    tool_versions = ['cppcheck --version']
+
     def __init__(self, *args):
         cog.task.Task.__init__(self, *args)
 
@@ -31,11 +55,7 @@ class CPPCheck(cog.task.Task):
         git_url = kwargs.get('git_url', None)
         base_repo_ref = kwargs.get('base_repo_ref', None)
         base_repo_url = kwargs.get('base_repo_url', None)
-        # In a future iteration of this code one might make the 
-        # ignore folder part a bit more generic
-        # For now just ignore the libpq subdir
-        ignore_folder_list = "-isrc/libpq -isrc/pygresql "
-        
+
         if sha is None:
             return {'success': False, 'reason': 'missing revision id'}
         if git_url is None:
@@ -68,25 +88,27 @@ class CPPCheck(cog.task.Task):
 
         # run cppcheck
         results = {'success': True, 'attachments': []}
-        cmd = 'cppcheck {ign_lst} src -j2 --enable=style --quiet --xml &> cppcheck.xml'.format(ign_lst=ignore_folder_list)
-        code = cog.task.system(cmd, checkout_path)
+        if base_repo_ref is not None and not kwargs.get('full_scan', False):
+            code, errors = self.check_changes(checkout_path, results)
+        else:
+            code, errors = CPPCheck.run_cppcheck(checkout_path, ['src'])
         results['cppcheck_returncode'] = code
 
-        # parse xml into formatted html page
-        tree = ElementTree()
-        tree.parse('%s/cppcheck.xml' % checkout_path)
-
+        # write formatted html page
         with open('%s/cppcheck.html' % checkout_path, 'w') as f:
             f.write('<html>\n<head>\n<title>cppcheck Results, ')
             f.write('%s</title>\n' % sha)
             f.write('</head>\n<body>\n<h1>cppcheck Results, ')
             f.write('%s</h1>\n' % sha)
+            if 'checked_files' in results:
+                f.write('<p>Checked %(checked_files)i changed or dependent '
+                        'files; %(baseline_errors)i issues already in the '
+                        'base branch are not shown.</p>\n' % results)
             f.write('<style>body {margin:5px;}</style>\n')
             f.write('<table>\n<tr>\n<th>Filename</th>\n<th>Line</th>\n')
             f.write('<th>Message</th>\n<th>Type</th>\n<th>Severity</th>\n')
             f.write('</tr>')
-            for err in tree.findall('error'):
-                error = err.attrib
+            for error in errors:
                 f.write('<tr')
                 if (error['severity'] == 'error' or
                         error['id'] in CPPCheck.critical_ids):
@@ -113,6 +135,214 @@ class CPPCheck(cog.task.Task):
 
         return results
 
+    @staticmethod
+    def run_cppcheck(directory, paths, output='cppcheck.xml'):
+        '''Run cppcheck and parse the errors it reports.
+
+        :param directory: Directory to run in
+        :param paths: Files and directories to check, relative to `directory`
+        :param output: Name of the XML output file, in `directory`
+        :returns: Tuple of (return code, list of error attribute
+                  dictionaries)
+        '''
+        if not paths:
+            return 0, []
+
+        list_file = os.path.join(directory, output + '.files')
+        with open(list_file, 'w') as f:
+            f.write('\n'.join(paths) + '\n')
+
+        ignore = ' '.join('-i' + path for path in CPPCheck.ignore_dirs)
+        cmd = ('cppcheck {ignore} --file-list={files} -j{jobs} --enable=style '
+               '--quiet --xml &> {output}'.format(ignore=ignore,
+                                                 files=list_file,
+                                                 jobs=cog.task.cpu_count(),
+                                                 output=output))
+        code = cog.task.system(cmd, directory)
+
+        tree = ElementTree()
+        tree.parse(os.path.join(directory, output))
+
+        return code, [dict(err.attrib) for err in tree.findall('error')]
+
+    @staticmethod
+    def get_include_index(checkout_path, tree, changed_files):
+        '''Map each header name to the files that include it.
+
+        The index of the base branch tree is kept in the analysis cache, and
+        the entries of files changed by the merge are rescanned from the
+        checkout. Includes are matched by file name, so a header may appear
+        to be used by more files than it is, which only costs extra checking.
+
+        :param checkout_path: Path to the merged checkout
+        :param tree: SHA of the base branch tree
+        :param changed_files: Paths changed by the merge
+        :returns: Dictionary of header file names to lists of paths
+        '''
+        name = 'cppcheck-includes-%s.json' % tree
+        includes = cog.task.load_analysis(name)
+        if includes is None:
+            includes = collections.defaultdict(list)
+            output = cog.task.system_output(
+                'git grep -I -E "^\\s*#\\s*include" %s -- src || true' % tree,
+                checkout_path)
+            for line in output.splitlines():
+                # lines are "tree:path:text"
+                parts = line.split(':', 2)
+                if len(parts) < 3 or not parts[1].endswith(
+                        CPPCheck.source_exts):
+                    continue
+                match = CPPCheck.include_re.match(parts[2])
+                if match:
+                    includes[parts[1]].append(
+                        os.path.basename(match.group(1)))
+            cog.task.save_analysis(name, includes)
+
+        for path in changed_files:
+            if not path.endswith(CPPCheck.source_exts):
+                continue
+            includes[path] = []
+            try:
+                with open(os.path.join(checkout_path, path)) as f:
+                    for line in f:
+                        match = CPPCheck.include_re.match(line)
+                        if match:
+                            includes[path].append(
+                                os.path.basename(match.group(1)))
+            except IOError:
+                pass  # deleted by the merge
+
+        index = collections.defaultdict(list)
+        for path, headers in includes.items():
+            for header in set(headers):
+                index[header].append(path)
+
+        return index
+
+    def get_targets(self, checkout_path, base_sha):
+        '''Find the files a merge needs checked.
+
+        These are the changed source files and, transitively, the files that
+        include a changed header.
+
+        :param checkout_path: Path to the merged checkout
+        :param base_sha: SHA of the base branch commit (see `cog.task.get_base_sha`)
+        :returns: Sorted list of paths
+        '''
+        changed_files = cog.task.get_changed_files('HEAD', checkout_path,
+                                                   base=base_sha)
+        tree = cog.task.system_output('git rev-parse "%s^{tree}"' % base_sha,
+                                      checkout_path).strip()
+        index = CPPCheck.get_include_index(checkout_path, tree,
+                                           set(changed_files))
+
+        targets = set()
+        pending = [path for path in changed_files
+                   if path.endswith(CPPCheck.source_exts)]
+        while pending:
+            path = pending.pop()
+            if path in targets:
+                continue
+            targets.add(path)
+
+            if path.endswith(CPPCheck.header_exts):
+                pending += index.get(os.path.basename(path), [])
+
+        return sorted(
+            path for path in targets
+            if os.path.exists(os.path.join(checkout_path, path)) and
+            path.startswith('src/') and
+            not any(path.startswith(d + '/') for d in CPPCheck.ignore_dirs))
+
+    def get_baseline(self, checkout_path, base_sha, targets):
+        '''Run cppcheck on the base branch versions of some files.
+
+        The files are checked in a worktree of the whole base branch, so
+        headers resolve as they do in the merged checkout. Results are kept
+        in the analysis cache, keyed by the base tree, the files and the
+        cppcheck version.
+
+        :param checkout_path: Path to the merged checkout
+        :param base_sha: SHA of the base branch commit (see `cog.task.get_base_sha`)
+        :param targets: Paths of the files to check
+        :returns: List of error attribute dictionaries
+        '''
+        if not targets:
+            return []
+
+        tree = cog.task.system_output('git rev-parse "%s^{tree}"' % base_sha,
+                                      checkout_path).strip()
+        version = cog.task.system_output('cppcheck --version')
+        key = hashlib.sha1(json.dumps([tree, targets, version])).hexdigest()
+        name = 'cppcheck-baseline-%s.json' % key
+
+        baseline = cog.task.load_analysis(name)
+        if baseline is not None:
+            return baseline
+
+        # files added by the merge have no baseline
+        base_files = cog.task.system_output(
+            'git ls-tree -r --name-only %s -- %s' % (base_sha,
+                                                     ' '.join(targets)),
+            checkout_path).splitlines()
+        if not base_files:
+            return []
+
+        base_dir = os.path.join(self.work_dir, 'cppcheck-base')
+        if os.path.exists(base_dir):
+            shutil.rmtree(base_dir)
+        cog.task.system('git worktree prune', checkout_path)
+
+        code = cog.task.system('git worktree add -q --detach %s %s' %
+                               (base_dir, base_sha), checkout_path)
+        if code != 0:
+            print 'get_baseline: git worktree add failed with code %i' % code
+            return []
+
+        try:
+            code, baseline = CPPCheck.run_cppcheck(base_dir, base_files)
+        finally:
+            cog.task.system('git worktree remove --force %s' % base_dir,
+                            checkout_path)
+
+        cog.task.save_analysis(name, baseline)
+
+        return baseline
+
+    def check_changes(self, checkout_path, results):
+        '''Check only what a merge changes, against a base branch baseline.
+
+        Issues are matched to the baseline by file, ID, severity and message,
+        so issues that only moved lines are not reported again.
+
+        :param checkout_path: Path to the merged checkout
+        :param results: Results dictionary, updated with counts of files
+                        checked and baseline issues
+        :returns: Tuple of (return code, list of new error attribute
+                  dictionaries)
+        '''
+        base_sha = cog.task.get_base_sha(checkout_path)
+        targets = self.get_targets(checkout_path, base_sha)
+        code, errors = CPPCheck.run_cppcheck(checkout_path, targets)
+        baseline = self.get_baseline(checkout_path, base_sha, targets)
+
+        def signature(error):
+            return (error.get('file'), error.get('id'), error.get('severity'),
+                    error.get('msg'))
+
+        known = collections.Counter(signature(error) for error in baseline)
+        new_errors = []
+        for error in errors:
+            if known[signature(error)] > 0:
+                known[signature(error)] -= 1
+            else:
+                new_errors.append(error)
+
+        results['checked_files'] = len(targets)
+        results['baseline_errors'] = len(errors) - len(new_errors)
+
+        return code, new_errors
+
 
 if __name__ == '__main__':
     import sys
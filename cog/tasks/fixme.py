@@ -1,14 +1,122 @@
 '''A task that checks for instances of the word "fixme"'''
 
 import os
+import re
+import mmap
 import subprocess
+import collections
 import cog.task
 
 class FIXMECheck(cog.task.Task):
     '''Find the word "fixme" in the code.'''
+    fixme_re = re.compile(r'fixme', re.IGNORECASE)
+
     def __init__(self, *args):
         cog.task.Task.__init__(self, *args)
 
+    @staticmethod
+    def list_files(checkout_path):
+        '''List the tracked text files in a checkout.
+
+        Files git considers binary, from their contents or attributes, are
+        skipped, as are symlinks and submodules.
+
+        :param checkout_path: Path to the checkout
+        :returns: Dictionary of paths to blob SHAs
+        '''
+        output = cog.task.system_output('git ls-files -s --eol -z',
+                                        checkout_path)
+
+        # entries look like "<mode> <blob> <stage>\t<eol info>\t<path>"
+        files = {}
+        for entry in output.split('\0'):
+            if not entry:
+                continue
+            info, eol, fname = entry.split('\t', 2)
+            mode, blob = info.split()[:2]
+            if mode not in ('100644', '100755'):
+                continue
+            if 'i/-text' in eol or re.search(r'attr/.*(-text|binary)', eol):
+                continue
+            files[fname] = blob
+
+        return files
+
+    @staticmethod
+    def scan(checkout_path, fnames):
+        '''Find the lines containing "fixme" in some files.
+
+        :param checkout_path: Path to the checkout
+        :param fnames: Paths of the files to scan, relative to the checkout
+        :returns: List of (path, line number string, line) tuples
+        '''
+        hits = []
+        for fname in sorted(fnames):
+            path = os.path.join(checkout_path, fname)
+            if not os.path.isfile(path) or not os.path.getsize(path):
+                continue
+
+            with open(path, 'rb') as f:
+                contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    # count lines incrementally between matches
+                    line_number, position, line_end = 1, 0, -1
+                    for match in FIXMECheck.fixme_re.finditer(contents):
+                        if match.start() <= line_end:
+                            continue  # another match on the same line
+                        line_start = contents.rfind('\n', 0,
+                                                    match.start()) + 1
+                        line_number += \
+                            contents[position:line_start].count('\n')
+                        position = line_start
+                        line_end = contents.find('\n', match.end())
+                        if line_end < 0:
+                            line_end = len(contents)
+                        hits.append((fname, str(line_number),
+                                     contents[line_start:line_end]))
+                finally:
+                    contents.close()
+
+        return hits
+
+    @staticmethod
+    def blame_lines(checkout_path, fname, lines):
+        '''Find the commit and author that last changed some lines of a file.
+
+        All lines are blamed with one git process.
+
+        :param checkout_path: Path to the checkout
+        :param fname: Path of the file, relative to the checkout
+        :param lines: Line numbers, as strings
+        :returns: Dictionary of line number strings to (revision, author)
+                  tuples, missing lines that could not be blamed
+        '''
+        cmd = ['git', 'blame', '--porcelain']
+        for line in lines:
+            cmd += ['-L', '%s,%s' % (line, line)]
+        cmd += ['--', fname]
+        pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                cwd=checkout_path)
+        output = pipe.communicate()[0]
+
+        # headers look like "<sha> <orig line> <final line> [<count>]", and
+        # the commit details follow only the first time each commit appears
+        authors = {}
+        blame = {}
+        rev = line = None
+        for entry in output.splitlines():
+            if entry.startswith('\t'):
+                blame[line] = rev
+                continue
+            fields = entry.split()
+            if len(fields) in (3, 4) and len(fields[0]) == 40:
+                rev, line = fields[0], fields[2]
+            elif fields and fields[0] == 'author':
+                authors[rev] = ' '.join(fields[1:])
+
+        return dict((line, (rev, authors.get(rev, '')))
+                    for line, rev in blame.items())
+
     def run(self, document, work_dir):
         '''Run the task.
 
@@ -51,15 +159,36 @@ class FIXMECheck(cog.task.Task):
 
         checkout_path = os.path.join(work_dir, sha)
 
-        # find instances of fixme
+        # find instances of fixme, only in the files a merge changes if the
+        # "changed_only" argument is given
         results = {'success': True, 'attachments': []}
-        cmd = ' '.join(['grep', '-irn', '--exclude=fixme.txt',
-                        '--exclude=*.git', '--exclude=*.svn', 'fixme', '.',
-                        '&> fixme.txt'])
-        code = cog.task.system(cmd, checkout_path)
-        results['grep_returncode'] = code
-
-        # parse grep output into formatted html page
+        blobs = FIXMECheck.list_files(checkout_path)
+        fnames = blobs.keys()
+        if base_repo_ref is not None and kwargs.get('changed_only', False):
+            base_sha = cog.task.get_base_sha(checkout_path)
+            changed_files = cog.task.get_changed_files('HEAD', checkout_path,
+                                                       base=base_sha)
+            fnames = [fname for fname in changed_files if fname in blobs]
+        hits = FIXMECheck.scan(checkout_path, fnames)
+        results['fixme_count'] = len(hits)
+
+        # blame all hits in a file at once, reusing blames of unchanged files
+        hit_lines = collections.defaultdict(list)
+        for fname, line, code in hits:
+            hit_lines[fname].append(line)
+
+        blames = {}
+        for fname, lines in hit_lines.items():
+            name = 'fixme-blame-%s.json' % blobs[fname]
+            cached = cog.task.load_analysis(name) or {}
+            missing = [line for line in lines if line not in cached]
+            if missing:
+                cached.update(FIXMECheck.blame_lines(checkout_path, fname,
+                                                     missing))
+                cog.task.save_analysis(name, cached)
+            blames[fname] = cached
+
+        # format the hits into an html page
         with open(os.path.join(checkout_path,'fixme.html'),'w') as fixme_html:
             fixme_html.write('<html>\n<head>\n')
             fixme_html.write('<title>FIXME Detector</title>\n')
@@ -68,21 +197,13 @@ class FIXMECheck(cog.task.Task):
             fixme_html.write('<table border>\n<tr>\n')
             fixme_html.write('<th>File</th>\n<th>Line</th>\n')
             fixme_html.write('<th>Code</th>\n<th>Last Edited</th>\n</tr>')
-            with open(os.path.join(checkout_path,'fixme.txt'),'r') as fixme_txt:
-                for item in fixme_txt.readlines():
-                    fname, line, code = [x.lstrip() for x in item.split(':', 2)]
-                    fixme_html.write('<tr>\n<td>%s</td>\n<td>%s</td>\n<td>%s</td>\n' %
-                                     (fname, line, code))
-
-                    cmd = ['git', 'blame', '-p', '-L', '%s,%s' % (line, line),
-                           fname]
-                    pipe = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                            cwd=checkout_path)
-                    blame = pipe.communicate()[0].splitlines()
-                    last_rev = blame[0].split()[0]
-                    last_author = ' '.join(blame[1].split()[1:])
-                    fixme_html.write('<td>%s, %s</td>\n</tr>\n' %
-                                     (last_author, last_rev))
+            for fname, line, code in hits:
+                fixme_html.write('<tr>\n<td>%s</td>\n<td>%s</td>\n<td>%s</td>\n' %
+                                 (fname, line, code.strip()))
+
+                last_rev, last_author = blames[fname].get(line, ('', ''))
+                fixme_html.write('<td>%s, %s</td>\n</tr>\n' %
+                                 (last_author, last_rev))
 
             fixme_html.write('</table>\n</body>\n</html>')
 
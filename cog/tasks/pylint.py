@@ -1,15 +1,34 @@
 '''A task that runs pylint on a revision.'''
 
+import re
 import json
 import glob
+import hashlib
 import os.path
+import multiprocessing
 import cog.task
 
 class PyLint(cog.task.Task):
     '''
     Run a linter over Python code to ensure consistent standards are met.
     Run pylint over code with certain warning enabled.
+
+    Files are split into shards that are linted in parallel, one per CPU of
+    the job. If the analysis cache is enabled, messages are cached per file,
+    and only files that changed or import a changed module are linted; see
+    `lint_incremental`. The "full_scan" argument lints everything.
     '''
+    cache_results = True
+    tool_versions = ['python3 -m pylint --version']
+
+    # matches "import a.b, c as d" and "from .a import b, c"
+    import_re = re.compile(r'^\s*(?:from\s+(\.*[\w.]*)\s+import\s+\(?([^#]*)|'
+                           r'import\s+([^#]*))')
+
+    # return code bits pylint uses for each message type
+    type_bits = {'fatal': 1, 'error': 2, 'warning': 4, 'refactor': 8,
+                 'convention': 16}
+
     def __init__(self, *args):
         cog.task.Task.__init__(self, *args)
 
@@ -23,6 +42,12 @@ class PyLint(cog.task.Task):
                                  'W0511', 'E0602', 'C1803', 'C1804', 'C1805',
                                  'R1734', 'C0201', 'C0411']
 
+        # Files are linted in shards, and only changed files are relinted,
+        # so checks across modules would depend on which files share a run.
+        # Cyclic imports (R0401) are such a check; like duplicate code
+        # (R0801) it is disabled.
+        self.messages_disable.append('R0401')
+
         # List of files or directories to ignore.
         # Note the limitiation of basenames.
         self.ignore_list = ['ipyroot.py', 'PSQL.scons',
@@ -108,19 +133,20 @@ class PyLint(cog.task.Task):
                     '--output-format=json',
                     '--ignore={0}'.format(','.join(self.ignore_list))]
 
-        # Unnamed arguments (the files to process).
-        cmd_list += self.file_list
-
         # Get the command string (without pipes to files) for storing in the document.
         # Exclude the JSON formatting option since it is only for processing.
-        pylint_command = ' '.join([c for c in cmd_list if c != '--output-format=json'])
-
-        # Output the log.
-        cmd_list += ['>', file_json_pylint, '2>', file_log_pylint]
+        pylint_command = ' '.join([c for c in cmd_list + self.file_list
+                                   if c != '--output-format=json'])
 
-        # Finally, run the command.
-        cmd = ' '.join(cmd_list)
-        code = cog.task.system(cmd, checkout_path)
+        results = {}
+        if cog.task.ANALYSIS_CACHE_DIR and not kwargs.get('full_scan', False):
+            code = self.lint_incremental(checkout_path, cmd_list, versions,
+                                         file_json_pylint, file_log_pylint,
+                                         results)
+        else:
+            code = self.run_pylint(checkout_path, cmd_list,
+                                   self.get_python_files(checkout_path),
+                                   file_json_pylint, file_log_pylint)
 
         # If there was an error, return unsuccessful.
         if os.path.getsize(file_log_pylint):
@@ -135,7 +161,6 @@ class PyLint(cog.task.Task):
             return results
 
         # Success is determined by return code of zero for pylint.
-        results = {}
         results['pylint_returncode'] = code
         results['success'] = not bool(code)
 
@@ -152,6 +177,239 @@ class PyLint(cog.task.Task):
 
         return results
 
+    def get_python_files(self, checkout_path):
+        '''
+        Expand the file list into individual files, skipping ignored names.
+
+        :param checkout_path: Path to the checkout
+        :returns: List of paths relative to the checkout
+        '''
+        files = []
+        for path in self.file_list:
+            full_path = os.path.join(checkout_path, path)
+            if not os.path.isdir(full_path):
+                if os.path.basename(path) not in self.ignore_list:
+                    files.append(path)
+                continue
+
+            for dirpath, dirnames, filenames in os.walk(full_path):
+                dirnames[:] = sorted(d for d in dirnames
+                                     if d not in self.ignore_list)
+                for filename in sorted(filenames):
+                    if (filename.endswith('.py') and
+                            filename not in self.ignore_list):
+                        files.append(os.path.relpath(
+                            os.path.join(dirpath, filename), checkout_path))
+
+        return files
+
+    def get_imports(self, checkout_path, files):
+        '''
+        Find the modules among some files that each file imports.
+
+        Imports are found with a regular expression rather than parsed, and
+        module names are resolved relative to the directories in the file
+        list, so this may find extra dependencies but should not miss any
+        except dynamic imports.
+
+        :param checkout_path: Path to the checkout
+        :param files: Paths of the files, relative to the checkout
+        :returns: Dictionary of each path to a set of paths it imports
+        '''
+        # module names of each file, relative to the file list directories
+        modules = {}
+        roots = [p for p in self.file_list
+                 if os.path.isdir(os.path.join(checkout_path, p))]
+        for path in files:
+            name = os.path.splitext(path)[0]
+            for root in roots:
+                if path.startswith(root + '/'):
+                    name = os.path.relpath(name, root)
+            name = name.replace('/', '.')
+            if name.endswith('.__init__'):
+                name = name[:-len('.__init__')]
+            modules[name] = path
+            modules.setdefault(name.split('.')[-1], path)
+
+        imports = {}
+        for path in files:
+            package = os.path.dirname(path).replace('/', '.')
+            names = set()
+            with open(os.path.join(checkout_path, path)) as f:
+                for line in f:
+                    match = PyLint.import_re.match(line)
+                    if not match:
+                        continue
+                    module, from_names, import_names = match.groups()
+                    if module is None:
+                        for name in import_names.split(','):
+                            name = name.split()[0] if name.split() else ''
+                            while name:
+                                names.add(name)
+                                name = name.rpartition('.')[0]
+                        continue
+
+                    # resolve relative imports against the file's package
+                    level = len(module) - len(module.lstrip('.'))
+                    module = module.lstrip('.')
+                    if level:
+                        base = package.split('.')[:len(package.split('.')) -
+                                                  level + 1]
+                        module = '.'.join(base + ([module] if module else []))
+                    for name in from_names.strip(' \\()\n').split(','):
+                        name = name.split()[0] if name.split() else ''
+                        if name:
+                            names.add(module + '.' + name if module else name)
+                    while module:
+                        names.add(module)
+                        module = module.rpartition('.')[0]
+
+            # relative imports give "python.rat.x"-style names, so also try
+            # each name relative to the file list directories
+            found = set()
+            for name in names:
+                for root in roots:
+                    prefix = root.replace('/', '.') + '.'
+                    if name.startswith(prefix):
+                        name = name[len(prefix):]
+                if name in modules and modules[name] != path:
+                    found.add(modules[name])
+            imports[path] = found
+
+        return imports
+
+    def lint_incremental(self, checkout_path, cmd_list, versions,
+                         file_json, file_log, results):
+        '''
+        Lint only the files whose cached messages are out of date.
+
+        Messages are cached per file, keyed by the file's blob SHA, the blob
+        SHAs of the files it imports, the pylint version and the options, so
+        a change to a file also re-lints the files that import it directly.
+        The messages of all files are written to `file_json`.
+
+        :param checkout_path: Path to the checkout
+        :param cmd_list: The pylint command, without files or redirections
+        :param versions: Output of pylint --version
+        :param file_json: The JSON file to write all messages to
+        :param file_log: The file to write pylint's stderr to
+        :param results: Results dictionary, updated with file counts
+        :returns: The pylint return code, including cached messages
+        '''
+        files = self.get_python_files(checkout_path)
+        imports = self.get_imports(checkout_path, files)
+
+        blobs = {}
+        for line in cog.task.system_output('git ls-files -s',
+                                           checkout_path).splitlines():
+            info, path = line.split('\t', 1)
+            blobs[path] = info.split()[1]
+
+        options = ' '.join(cmd_list) + versions
+        keys = {}
+        for path in files:
+            key = [blobs.get(path, '')]
+            key += sorted(blobs.get(p, '') for p in imports[path])
+            key.append(options)
+            keys[path] = hashlib.sha1('\n'.join(key)).hexdigest()
+
+        messages = []
+        stale = []
+        for path in files:
+            cached = cog.task.load_analysis('pylint-%s.json' % keys[path])
+            if cached is None or path not in blobs:
+                stale.append(path)
+            else:
+                messages += cached
+
+        code = 0
+        if stale:
+            code = self.run_pylint(checkout_path, cmd_list, stale,
+                                   file_json, file_log)
+
+            # only cache complete runs
+            if not os.path.getsize(file_log) and not code & 32:
+                with open(file_json) as f:
+                    new_messages = json.load(f)
+                by_path = dict((path, []) for path in stale)
+                for message in new_messages:
+                    by_path.setdefault(message['path'], []).append(message)
+                for path in stale:
+                    if path in blobs:
+                        cog.task.save_analysis('pylint-%s.json' % keys[path],
+                                               by_path[path])
+                messages += new_messages
+        else:
+            open(file_log, 'w').close()
+
+        with open(file_json, 'w') as f:
+            json.dump(messages, f)
+
+        for message in messages:
+            code |= PyLint.type_bits.get(message.get('type'), 0)
+
+        results['linted_files'] = len(stale)
+        results['cached_files'] = len(files) - len(stale)
+
+        return code
+
+    def run_pylint(self, checkout_path, cmd_list, files, file_json, file_log):
+        '''
+        Run pylint over files in parallel shards and merge the output.
+
+        Files are assigned to shards largest first, each to the shard with
+        the fewest bytes so far, so that shards take about as long.
+
+        :param checkout_path: Path to the checkout
+        :param cmd_list: The pylint command, without files or redirections
+        :param files: Paths of the files to lint, relative to the checkout
+        :param file_json: The JSON file to write all messages to
+        :param file_log: The file to write all of pylint's stderr to
+        :returns: The return codes of the shards, combined
+        '''
+        n_shards = max(min(cog.task.cpu_count(), len(files)), 1)
+        shards = [[] for i in range(n_shards)]
+        sizes = [0] * n_shards
+        for path in sorted(files, reverse=True,
+                           key=lambda p: os.path.getsize(
+                               os.path.join(checkout_path, p))):
+            i = sizes.index(min(sizes))
+            shards[i].append(path)
+            sizes[i] += os.path.getsize(os.path.join(checkout_path, path))
+
+        args = []
+        for i, shard in enumerate(shards):
+            cmd = ' '.join(cmd_list + shard +
+                           ['>', '%s.%i' % (file_json, i),
+                            '2>', '%s.%i' % (file_log, i)])
+            args.append((cmd, checkout_path))
+
+        if n_shards == 1:
+            codes = [run_pylint_shard(args[0])]
+        else:
+            pool = multiprocessing.Pool(n_shards)
+            codes = pool.map(run_pylint_shard, args)
+            pool.close()
+            pool.join()
+
+        code = 0
+        messages = []
+        with open(file_log, 'w') as log:
+            for i, shard_code in enumerate(codes):
+                code |= shard_code
+                with open('%s.%i' % (file_log, i)) as f:
+                    log.write(f.read())
+                try:
+                    with open('%s.%i' % (file_json, i)) as f:
+                        messages += json.load(f)
+                except ValueError:
+                    pass  # pylint crashed, which is in the log
+
+        with open(file_json, 'w') as f:
+            json.dump(messages, f)
+
+        return code
+
     def create_html_file(self, file_json_in, file_html_out,
                          pylint_command, pylint_version, sha=''):
         '''
@@ -268,6 +526,16 @@ def create_pylint_html_table(pylint_list_objs):
 
     return table
 
+def run_pylint_shard(args):
+    '''
+    Run pylint on one shard of files in a worker process.
+
+    :param args: Tuple of (pylint command string, working directory)
+    :returns: The pylint return code
+    '''
+    cmd, checkout_path = args
+    return cog.task.system(cmd, checkout_path)
+
 if __name__ == '__main__':
     import sys
     task = PyLint(*(sys.argv[1:]))
@@ -1,6 +1,8 @@
 '''A task that runs a rattest.'''
 
 import os
+import copy
+import multiprocessing
 import cog.task
 
 class RATTest(cog.task.Task):
@@ -16,21 +18,38 @@ class RATTest(cog.task.Task):
         '''
         kwargs = document.get('kwargs', {})
         testname = kwargs.get('testname')
+
+        if testname is None:
+            return {'success': False, 'reason': 'missing test name'}
+
+        checkout_path, results = self.prepare(document, work_dir)
+        if not results['success']:
+            return results
+
+        return RATTest.run_test(checkout_path, testname, results)
+
+    def prepare(self, document, work_dir):
+        '''Check out and build the revision under test.
+
+        :param document: Task document from the database
+        :param work_dir: Temporary working directory
+        :returns: Tuple of (checkout path, results so far), where the results
+                  are unsuccessful if the revision could not be built
+        '''
+        kwargs = document.get('kwargs', {})
         sha = kwargs.get('sha')
         git_url = kwargs.get('git_url')
         base_repo_ref = kwargs.get('base_repo_ref')
         base_repo_url = kwargs.get('base_repo_url')
 
-        if testname is None:
-            return {'success': False, 'reason': 'missing test name'}
         if sha is None:
-            return {'success': False, 'reason': 'missing revision id'}
+            return None, {'success': False, 'reason': 'missing revision id'}
         if git_url is None:
-            return {'success': False, 'reason': 'missing git url'}
+            return None, {'success': False, 'reason': 'missing git url'}
         if (base_repo_url and base_repo_ref is None or
                 base_repo_ref and base_repo_url is None):
-            return {'success': False,
-                    'reason': 'incomplete base specification for merge'}
+            return None, {'success': False,
+                          'reason': 'incomplete base specification for merge'}
 
         # Get the code
         # Case 1: Just check out a repo and run
@@ -38,8 +57,8 @@ class RATTest(cog.task.Task):
             code, log = cog.task.git_clone(git_url, sha, sha,
                                            work_dir=work_dir, log=True)
             if code is None or code != 0:
-                return {'success': False, 'reason': 'git clone failed',
-                        'code': str(code), 'log': str(log)}
+                return None, {'success': False, 'reason': 'git clone failed',
+                              'code': str(code), 'log': str(log)}
 
         # Case 2: Simulate a GitHub Pull request merge
         else:
@@ -48,8 +67,8 @@ class RATTest(cog.task.Task):
                                              work_dir=work_dir,
                                              log=True)
             if code is None or code != 0:
-                return {'success': False, 'reason': 'git merge failed',
-                        'code': str(code), 'log': str(log)}
+                return None, {'success': False, 'reason': 'git merge failed',
+                              'code': str(code), 'log': str(log)}
 
         checkout_path = os.path.join(work_dir, sha)
 
@@ -59,7 +78,8 @@ class RATTest(cog.task.Task):
         results['scons_returncode'] = code
 
         if code is None:
-            return {'success': False, 'reason': 'configure failed'}
+            return checkout_path, {'success': False,
+                                   'reason': 'configure failed'}
 
         if code != 0:
             results['success'] = False
@@ -71,25 +91,34 @@ class RATTest(cog.task.Task):
                 'link_name': 'Build Log'
             })
 
-            return results
+        return checkout_path, results
 
+    @staticmethod
+    def run_test(checkout_path, testname, results):
+        '''Run a rattest in a built checkout and attach its output.
+
+        :param checkout_path: Path to the built checkout
+        :param testname: Name of the rattest
+        :param results: Results so far, which are updated
+        :returns: The results
+        '''
         # run the requested rattest
         testpath = os.path.join(checkout_path, 'test', 'full')
-        code = cog.task.system('source ../../env.sh &> rattest.log && rattest -t %s >>rattest.log 2>&1'
-                               % testname, testpath)
+        logname = 'rattest-%s.log' % testname
+        code = cog.task.system('source ../../env.sh &> %s && rattest -t %s >>%s 2>&1'
+                               % (logname, testname, logname), testpath)
         if code != 0:
             results['success'] = False
             results['reason'] = 'rattest failed'
-            with open('%s/rattest.log' % testpath, 'r') as log_file:
-                log_text = log_file.read()
             results['attachments'].append({
                 'filename': 'rattest.txt',
-                'contents': log_text,
+                'path': os.path.join(testpath, logname),
+                'gzip': True,
                 'link_name': 'rattest.log'
             })
             
 
-        # attach results
+        # attach results; files are streamed from disk when uploaded
         for root, dirs, files in os.walk(os.path.join(testpath, testname),
                                          topdown=False):
             for name in files:
@@ -103,20 +132,96 @@ class RATTest(cog.task.Task):
                         os.path.getsize(fname) > 524288000):
                     continue
 
-                with open(fname,'r') as results_file:
-                    attachment = {
-                        'filename': basename,
-                        'contents': results_file.read()
-                    }
-                    if basename == 'results.html':
-                        attachment['link_name'] = 'rattest Results'
-                    results['attachments'].append(attachment)
+                attachment = {
+                    'filename': basename,
+                    'path': fname,
+                    'gzip': basename.endswith(('.log', '.txt'))
+                }
+                if basename == 'results.html':
+                    attachment['link_name'] = 'rattest Results'
+                results['attachments'].append(attachment)
 
         return results
 
 
+class RATTestGroup(object):
+    '''Run several rattests of one revision in a single job.
+
+    The revision is checked out and built once, then the tests are run in
+    parallel on the CPUs allocated to the job. Each test posts its results to
+    its own task document, as if it had run alone.
+
+    :param host: CouchDB hostname
+    :param dbname: CouchDB database name
+    :param username: Database username
+    :param password: Database password
+    :param manifest: Path to a manifest listing the task document IDs
+    '''
+    def __init__(self, host, dbname, username, password, manifest):
+        self.args = (host, dbname, username, password)
+        self.doc_ids = cog.task.read_manifest(manifest)
+
+    def __call__(self):
+        '''Build the revision and run the tests.'''
+        builder = RATTest(*(self.args + (self.doc_ids[0],)))
+        try:
+            checkout_path, results = builder.prepare(builder.document,
+                                                     builder.work_dir)
+        except Exception as e:
+            checkout_path, results = None, {
+                'success': False,
+                'reason': 'Unhandled exception in task: %s' % str(e)
+            }
+
+        # if the build failed, so did every test
+        if not results['success']:
+            for doc_id in self.doc_ids:
+                task = RATTest(*(self.args + (doc_id,)))
+                task.start()
+                task.finish(copy.deepcopy(results))
+            return
+
+        pool = multiprocessing.Pool(min(cog.task.cpu_count(),
+                                        len(self.doc_ids)))
+        pool.map(run_grouped_test, [self.args + (doc_id, checkout_path)
+                                    for doc_id in self.doc_ids])
+        pool.close()
+        pool.join()
+
+
+def run_grouped_test(args):
+    '''Run one test of a `RATTestGroup` in a worker process.
+
+    :param args: Tuple of (host, dbname, username, password, document ID,
+                 path to the built checkout)
+    '''
+    host, dbname, username, password, doc_id, checkout_path = args
+
+    task = RATTest(host, dbname, username, password, doc_id)
+    task.start()
+
+    testname = task.document.get('kwargs', {}).get('testname')
+    try:
+        if testname is None:
+            results = {'success': False, 'reason': 'missing test name'}
+        else:
+            results = RATTest.run_test(checkout_path, testname,
+                                       {'success': True, 'attachments': [],
+                                        'scons_returncode': 0})
+    except Exception as e:
+        results = {
+            'success': False,
+            'reason': 'Unhandled exception in task: %s' % str(e)
+        }
+
+    task.finish(results)
+
+
 if __name__ == '__main__':
     import sys
-    task = RATTest(*(sys.argv[1:]))
+    if sys.argv[1] == '--group':
+        task = RATTestGroup(*(sys.argv[2:]))
+    else:
+        task = RATTest(*(sys.argv[1:]))
     task()
 
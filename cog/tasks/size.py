@@ -6,6 +6,10 @@ import cog.task
 
 class SizeCheck(cog.task.Task):
     '''Download the base and test repository, compare size.'''
+    # only the checked-out trees are measured
+    clone_strategy = {'depth': 1}
+    cache_results = True
+
     def __init__(self, *args):
         cog.task.Task.__init__(self, *args)
 
@@ -48,13 +52,15 @@ class SizeCheck(cog.task.Task):
                     'reason': 'incomplete base specification for merge'}
 
         # get the new pull request
-        code = cog.task.git_clone(git_url, sha, sha, work_dir=work_dir)
+        code = cog.task.git_clone(git_url, sha, sha, work_dir=work_dir,
+                                  strategy=self.clone_strategy)
         if code is None or (code != 0 and code != 1):
             return {'success': False, 'reason': 'git clone failed',
                     'code': str(code)}
 
         code = cog.task.git_clone(base_repo_url, base_repo_ref, 
-                                  base_repo_ref, work_dir=work_dir)
+                                  base_repo_ref, work_dir=work_dir,
+                                  strategy=self.clone_strategy)
         if code is None or (code != 0 and code != 1):
             return {'success': False, 'reason': 'git clone failed',
                     'code': str(code)}
@@ -0,0 +1,9 @@
+function(doc) {
+  if (doc.type == 'task' && doc.completed && doc.results &&
+      !doc.results.reason) {
+    if (doc.result_key)
+      emit(doc.result_key, null);
+    if (doc.input_key)
+      emit(doc.input_key, null);
+  }
+}